@@ -1,17 +1,141 @@
-from django.contrib import admin
+from decimal import Decimal
+from django import forms
+from django.contrib import admin, messages
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.core.exceptions import PermissionDenied, ValidationError
+from django.shortcuts import redirect
+from django.template.response import TemplateResponse
+from django.urls import path
 from reversion.admin import VersionAdmin
+from reversion.models import Revision
 from recoup import models
+from recoup.diff import revision_diff, year_diff
+from recoup.imports import COLUMNS, USER_COUNT_COLUMNS, Importer, UserCountSync, read_rows, read_user_counts
+from recoup.queries import with_costs
 from django.db.models import Sum
 
 
+class CostAdmin(VersionAdmin):
+    """
+    Computes cost columns in the changelist query itself rather than
+    running the model methods' queries for every row
+    """
+    def get_queryset(self, request):
+        return with_costs(super(CostAdmin, self).get_queryset(request))
+
+
 class InlineBillAdmin(admin.TabularInline):
     model = models.Bill
     fields = ["name", "year", "renewal_date", "cost", "cost_estimate"]
     extra = 0
 
 
+class RolloverForm(forms.Form):
+    uplift = forms.DecimalField(
+        initial=0, max_digits=5, decimal_places=2, help_text="Percentage increase applied to cost estimates")
+
+
+class RevisionChoiceField(forms.ModelChoiceField):
+    def label_from_instance(self, revision):
+        return "{} {} {}".format(revision.date_created.strftime("%Y-%m-%d %H:%M"), revision.user or "", revision.comment)
+
+
+class DiffForm(forms.Form):
+    """
+    Either two financial years, or one or two revisions of a financial year
+    """
+    before_year = forms.ModelChoiceField(models.FinancialYear.objects.all(), required=False)
+    after_year = forms.ModelChoiceField(models.FinancialYear.objects.all(), required=False)
+    before_revision = RevisionChoiceField(
+        Revision.objects.none(), required=False, help_text="Compare the year as of this revision")
+    after_revision = RevisionChoiceField(
+        Revision.objects.none(), required=False, help_text="With the year as of this revision, by default now")
+    year = forms.ModelChoiceField(
+        models.FinancialYear.objects.all(), required=False, help_text="The year revisions are compared for, by default the current one")
+
+    def __init__(self, *args, **kwargs):
+        super(DiffForm, self).__init__(*args, **kwargs)
+        recent = Revision.objects.filter(pk__in=Revision.objects.order_by("-pk").values("pk")[:200]).select_related("user")
+        self.fields["before_revision"].queryset = self.fields["after_revision"].queryset = recent
+
+    def clean(self):
+        data = super(DiffForm, self).clean()
+        if not data.get("before_revision") and not (data.get("before_year") and data.get("after_year")):
+            raise forms.ValidationError("Choose two financial years, or a revision to compare with")
+        return data
+
+    def diff(self):
+        data = self.cleaned_data
+        if data["before_revision"]:
+            return revision_diff(data["before_revision"], data["after_revision"], data["year"])
+        return year_diff(data["before_year"], data["after_year"])
+
+
+@admin.register(models.FinancialYear)
+class FinancialYearAdmin(CostAdmin):
+    list_display = ["__str__", "start", "end", "is_current", "closed", "cost", "cost_estimate"]
+    actions = ["rollover", "make_current", "close"]
+    change_list_template = "admin/recoup/financialyear/change_list.html"
+
+    def get_urls(self):
+        return [
+            path("diff/", self.admin_site.admin_view(self.diff_view), name="recoup_financialyear_diff"),
+        ] + super(FinancialYearAdmin, self).get_urls()
+
+    def diff_view(self, request):
+        """
+        Cost changes between two financial years or two revisions, largest first
+        """
+        if not self.has_change_permission(request):
+            raise PermissionDenied
+        form = DiffForm(request.GET or None)
+        diff = form.diff() if form.is_valid() else None
+        return TemplateResponse(request, "admin/recoup/financialyear/diff.html", dict(
+            self.admin_site.each_context(request), title="Compare costs", opts=self.model._meta,
+            form=form, diff=diff, top=diff.top() if diff else None))
+
+    def close(self, request, queryset):
+        for year in queryset.filter(closed__isnull=True):
+            year.close()
+            self.message_user(request, "Closed {}, its costs are now frozen".format(year), messages.SUCCESS)
+    close.short_description = "Close the financial year, freezing its costs"
+
+    def make_current(self, request, queryset):
+        if queryset.count() != 1:
+            self.message_user(request, "Select one financial year to make current", messages.ERROR)
+            return
+        year = queryset.get()
+        year.make_current()
+        self.message_user(request, "{} is now the current financial year".format(year), messages.SUCCESS)
+    make_current.short_description = "Make the current financial year"
+
+    def rollover(self, request, queryset):
+        """
+        Start the following year with copies of the selected year's active bills
+        """
+        if queryset.count() != 1:
+            self.message_user(request, "Select one financial year to roll over", messages.ERROR)
+            return None
+        year = queryset.get()
+        form = RolloverForm(request.POST if "apply" in request.POST else None)
+        if form.is_valid():
+            try:
+                new_year = year.rollover(form.cleaned_data["uplift"])
+            except ValidationError as e:
+                self.message_user(request, " ".join(e.messages), messages.ERROR)
+            else:
+                self.message_user(request, "Created {} with {} bills copied from {}".format(
+                    new_year, new_year.bill_set.count(), year), messages.SUCCESS)
+            return None
+        return TemplateResponse(request, "admin/recoup/financialyear/rollover.html", dict(
+            self.admin_site.each_context(request), title="Roll over {}".format(year), opts=self.model._meta,
+            year=year, form=form, bills=year.bill_set.filter(active=True).count(),
+            action_checkbox_name=admin.helpers.ACTION_CHECKBOX_NAME))
+    rollover.short_description = "Roll over to the next financial year"
+
+
 @admin.register(models.Contract)
-class ContractAdmin(VersionAdmin):
+class ContractAdmin(CostAdmin):
     list_display = ["__str__", "cost", "cost_estimate", "start", "active"]
     search_fields = ["bill__name", "bill__description", "bill__comment", "vendor", "reference", "brand"]
     inlines = [InlineBillAdmin]
@@ -53,17 +177,119 @@ class AllocatedListFilter(admin.SimpleListFilter):
             return qs.filter(cost_items__percentage__sum__gt=100)
 
 
+class EstimateAboveListFilter(admin.SimpleListFilter):
+    """
+    Cost estimate greater than a value, e.g. ?estimate_gt=25000
+    Filters on the annotations added by CostAdmin
+    """
+    title = "Estimate"
+    parameter_name = "estimate_gt"
+    field = "_cost_estimate"
+
+    def lookups(self, request, model_admin):
+        return (
+            ('1000', 'Over $1,000'),
+            ('10000', 'Over $10,000'),
+            ('100000', 'Over $100,000'),
+            ('1000000', 'Over $1,000,000'),
+        )
+
+    def queryset(self, request, queryset):
+        if self.value():
+            try:
+                value = Decimal(self.value())
+            except ArithmeticError:
+                value = None
+            if value is None or not value.is_finite():
+                raise IncorrectLookupParameters("{} must be a number".format(self.parameter_name))
+            return queryset.filter(**{"{}__gt".format(self.field): value})
+
+
+class TopEstimateListFilter(admin.SimpleListFilter):
+    """
+    The N rows with the highest cost estimate, e.g. ?top=20
+    """
+    title = "Highest estimate"
+    parameter_name = "top"
+    field = "_cost_estimate"
+
+    def lookups(self, request, model_admin):
+        return (
+            ('10', 'Top 10'),
+            ('20', 'Top 20'),
+            ('50', 'Top 50'),
+            ('100', 'Top 100'),
+        )
+
+    def queryset(self, request, queryset):
+        if self.value():
+            try:
+                count = int(self.value())
+            except ValueError:
+                count = -1
+            if count < 0:
+                raise IncorrectLookupParameters("{} must be a whole number".format(self.parameter_name))
+            # Nested as a subquery, so the changelist runs one query for the rows
+            top = queryset.order_by("-{}".format(self.field), "pk").values("pk")[:count]
+            return queryset.filter(pk__in=top)
+
+
+class SystemEstimateAboveListFilter(EstimateAboveListFilter):
+    title = "System estimate"
+    field = "_system_cost_estimate"
+
+
+class TopSystemEstimateListFilter(TopEstimateListFilter):
+    title = "Highest system estimate"
+    field = "_system_cost_estimate"
+
+
+class BillImportForm(forms.Form):
+    file = forms.FileField(help_text="A .csv or .xlsx file")
+    year = forms.ModelChoiceField(models.FinancialYear.objects.all())
+
+
 @admin.register(models.Bill)
-class BillAdmin(VersionAdmin):
+class BillAdmin(CostAdmin):
     list_display = ["__str__", "contract", "quantity", "cost", "cost_estimate", "allocated", "active"]
+    list_select_related = ["contract"]
     list_filter = ["year", AllocatedListFilter, "active"]
     search_fields = ["name", "description", "comment", "contract__vendor", "contract__reference", "contract__brand"]
     inlines = [EndUserCostAdmin, ITPlatformCostAdmin]
+    change_list_template = "admin/recoup/bill/change_list.html"
+
+    def get_urls(self):
+        return [
+            path("import/", self.admin_site.admin_view(self.import_view), name="recoup_bill_import"),
+        ] + super(BillAdmin, self).get_urls()
+
+    def import_view(self, request):
+        """
+        Bulk import contracts, bills and cost splits from a spreadsheet
+        """
+        if not (self.has_add_permission(request) and self.has_change_permission(request)):
+            raise PermissionDenied
+        form = BillImportForm(request.POST or None, request.FILES or None, initial={"year": models.FinancialYear.current()})
+        errors = []
+        if form.is_valid():
+            upload = form.cleaned_data["file"]
+            try:
+                contracts, bills, costs = Importer(read_rows(upload.name, upload), form.cleaned_data["year"]).save()
+            except ValidationError as e:
+                errors = e.messages
+            else:
+                self.message_user(request, "Imported {} contracts, {} bills and {} cost splits".format(
+                    contracts, bills, costs), messages.SUCCESS)
+                return redirect("admin:recoup_bill_changelist")
+        return TemplateResponse(request, "admin/recoup/bill/import.html", dict(
+            self.admin_site.each_context(request), title="Import bills", opts=self.model._meta,
+            form=form, errors=errors, columns=COLUMNS))
 
 
 @admin.register(models.EndUserService)
-class EndUserServiceAdmin(VersionAdmin):
+class EndUserServiceAdmin(CostAdmin):
     list_display = ["__str__", "total_user_count", "cost", "cost_estimate", "cost_percentage", "cost_estimate_percentage"]
+    list_filter = [EstimateAboveListFilter, TopEstimateListFilter]
     inlines = [EndUserCostAdmin]
 
 
@@ -74,27 +300,65 @@ class SystemDependencyAdmin(admin.TabularInline):
 
 
 @admin.register(models.Platform)
-class PlatformAdmin(VersionAdmin):
+class PlatformAdmin(CostAdmin):
     list_display = ["__str__", "system_count", "system_weight_total", "cost", "cost_estimate", "cost_percentage", "cost_estimate_percentage"]
+    list_filter = [EstimateAboveListFilter, TopEstimateListFilter]
     inlines = [ITPlatformCostAdmin, SystemDependencyAdmin]
 
 
 @admin.register(models.Division)
-class DivisionAdmin(VersionAdmin):
+class DivisionAdmin(CostAdmin):
     list_display = [
         "__str__", "user_count", "cc_count", "system_count", "bill", "cost", "cost_estimate",
         "cost_percentage", "cost_estimate_percentage", 'position']
+    list_filter = [EstimateAboveListFilter, TopEstimateListFilter]
+
+
+class UserCountSyncForm(forms.Form):
+    file = forms.FileField(help_text="A .json, .csv or .xlsx file")
 
 
 @admin.register(models.CostCentre)
-class CostCentreAdmin(VersionAdmin):
+class CostCentreAdmin(CostAdmin):
     list_display = ["__str__", "name", "division", "user_count", "system_count", "system_cost", "system_cost_estimate"]
     list_editable = ["user_count"]
+    list_filter = ["division", SystemEstimateAboveListFilter, TopSystemEstimateListFilter]
+    change_list_template = "admin/recoup/costcentre/change_list.html"
+
+    def get_urls(self):
+        return [
+            path("sync/", self.admin_site.admin_view(self.sync_view), name="recoup_costcentre_sync"),
+        ] + super(CostCentreAdmin, self).get_urls()
+
+    def sync_view(self, request):
+        """
+        Update user counts from an HR or directory export
+        """
+        if not self.has_change_permission(request):
+            raise PermissionDenied
+        form = UserCountSyncForm(request.POST or None, request.FILES or None)
+        errors = []
+        if form.is_valid():
+            upload = form.cleaned_data["file"]
+            try:
+                changed, unknown = UserCountSync(read_user_counts(upload.name, upload)).save()
+            except ValidationError as e:
+                errors = e.messages
+            else:
+                self.message_user(request, "Updated the user counts of {} cost centres".format(changed), messages.SUCCESS)
+                if unknown:
+                    self.message_user(request, "Skipped unknown cost centre codes: {}".format(
+                        ", ".join(unknown)), messages.WARNING)
+                return redirect("admin:recoup_costcentre_changelist")
+        return TemplateResponse(request, "admin/recoup/costcentre/sync.html", dict(
+            self.admin_site.each_context(request), title="Sync user counts", opts=self.model._meta,
+            form=form, errors=errors, columns=USER_COUNT_COLUMNS))
 
 
 @admin.register(models.ServicePool)
-class ServicePoolAdmin(VersionAdmin):
+class ServicePoolAdmin(CostAdmin):
     list_display = ["__str__", "cost", "cost_estimate", "cost_percentage", "cost_estimate_percentage"]
+    list_filter = [EstimateAboveListFilter, TopEstimateListFilter]
     inlines = [EndUserCostAdmin, ITPlatformCostAdmin]
 
     def has_delete_permission(self, request, obj=None):
@@ -105,8 +369,12 @@ class ServicePoolAdmin(VersionAdmin):
 
 
 @admin.register(models.ITSystem)
-class ITSystemAdmin(VersionAdmin):
+class ITSystemAdmin(CostAdmin):
     list_display = ["system_id", "name", "depends_on_display", "cost_centre", "division", "cost", "cost_estimate"]
-    list_filter = ["division", "depends_on"]
+    list_filter = ["division", "depends_on", EstimateAboveListFilter, TopEstimateListFilter]
     search_fields = ["name", "system_id", "cost_centre__name"]
+    list_select_related = ["cost_centre", "division"]
     inlines = [SystemDependencyAdmin]
+
+    def get_queryset(self, request):
+        return super(ITSystemAdmin, self).get_queryset(request).prefetch_related("depends_on")
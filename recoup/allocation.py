@@ -0,0 +1,519 @@
+from collections import defaultdict
+from decimal import Decimal
+from django.apps import apps
+from django.conf import settings
+from django.db.models import Sum
+import fcntl
+import glob
+import json
+import numpy as np
+import os
+
+from recoup import kernel, models, propagation
+from recoup.graph import Nodes, Table, map_columns, write_columns
+
+# Node values other than cost and cost_estimate held as Decimal, see Allocation.snapshot
+MONEY_VALUES = {"system_cost", "system_cost_estimate", "enduser_cost", "enduser_estimate"}
+# Node values held in cents in shared allocation files
+MONEY = MONEY_VALUES.union(("cost", "cost_estimate"))
+# The last shared allocation read by this process, by path
+_shared = {}
+
+
+def load_data(year=None):
+    """
+    Fetch every row the allocation graph for a financial year (by default the
+    current one) depends on, one query per table, as graph.Tables
+    """
+    year = year or models.FinancialYear.current()
+    return dict(
+        load_structure(),
+        year=year.pk if year else None,
+        bills=Table.load(
+            models.Bill.objects.filter(year=year), "pk", "contract_id", "name", "year_id", "active", "cost",
+            "cost_estimate"),
+        enduser_costs=Table.load(
+            models.EndUserCost.objects.filter(year=year), "bill_id", "service_pool_id", "service_id", "cost",
+            "cost_estimate"),
+        platform_costs=Table.load(
+            models.ITPlatformCost.objects.filter(year=year), "bill_id", "service_pool_id", "platform_id", "cost",
+            "cost_estimate"))
+
+
+def load_structure():
+    """
+    The rows of the graph shared by every financial year
+    """
+    return {
+        "dependencies": Table.load(models.SystemDependency.objects.all(), "system_id", "platform_id", "weighting"),
+        "systems": Table.load(models.ITSystem.objects.all(), "pk", "cost_centre_id", "division_id"),
+        "cost_centres": Table.load(models.CostCentre.objects.all(), "pk", "division_id", "user_count"),
+        "divisions": Table.load(models.Division.objects.all(), "pk", "user_count"),
+        "service_divisions": Table.load(
+            models.EndUserService.divisions.through.objects.all(), "enduserservice_id", "division_id"),
+    }
+
+
+class Allocation(object):
+    """
+    Costs for every node of the Bill -> Cost -> Platform/EndUserService -> ITSystem
+    -> CostCentre -> Division graph in one financial year, computed in a single
+    pass over the rows from load_data. Values match the equivalent model methods
+    and are looked up by model instance, e.g. allocation.get(division, "cost_estimate")
+    """
+    def __init__(self, data):
+        self.data = data
+        self.nodes = {}
+        # (division pk, service pk) -> (cost, estimate) of the division's share
+        self.division_services = {}
+        self.compute()
+
+    @classmethod
+    def load(cls, year=None):
+        """
+        The allocation for a financial year (by default the current one), read
+        from its snapshot once the year is closed
+        """
+        year = year or models.FinancialYear.current()
+        if year is not None and year.closed:
+            return cls.from_snapshot(year)
+        if year is None or not settings.ALLOCATION_ROOT or propagation.pending():
+            # Uncommitted changes mustn't be shared with other processes
+            return cls(load_data(year))
+        return cls.shared(year)
+
+    @staticmethod
+    def shared_path(year_id, version):
+        return os.path.join(settings.ALLOCATION_ROOT, "allocation-{}-{}.arrays".format(year_id, version))
+
+    @staticmethod
+    def path_version(path):
+        return int(os.path.splitext(path)[0].rsplit("-", 1)[1])
+
+    @classmethod
+    def shared(cls, year):
+        """
+        The allocation for a financial year from a file under ALLOCATION_ROOT
+        keyed by DataVersion, so that every worker process reads the same one.
+        The first process to find it missing computes it while holding a lock,
+        the others wait for it then read the file. Its nodes are memory mapped
+        (see graph.Nodes), so every process shares one copy of them in the
+        page cache rather than holding its own, and workers forked after warm
+        up (see recoup.warmup) start with the master's mapping
+        """
+        version = models.DataVersion.current()
+        path = cls.shared_path(year.pk, version)
+        if path in _shared:
+            return _shared[path]
+        allocation = cls.read(path)
+        if allocation is not None:
+            return cls.keep(path, allocation)
+        os.makedirs(settings.ALLOCATION_ROOT, exist_ok=True)
+        with open(os.path.join(settings.ALLOCATION_ROOT, "allocation-{}.lock".format(year.pk)), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            allocation = cls.read(path)
+            if allocation is not None:
+                return cls.keep(path, allocation)
+            allocation = cls.refreshed(year, version) or cls(load_data(year))
+            allocation.write(path)
+            # Mapped like every other process's, rather than kept as the dicts computed here
+            allocation = cls.read(path)
+            for old in glob.glob(cls.shared_path(year.pk, "*")):
+                if old != path:
+                    os.remove(old)
+        return cls.keep(path, allocation)
+
+    @classmethod
+    def refreshed(cls, year, version):
+        """
+        The last shared allocation of the year before version, refreshed with
+        the nodes changed since, or None without one or a record of every change
+        """
+        older = sorted(cls.path_version(path) for path in glob.glob(cls.shared_path(year.pk, "*")))
+        older = [number for number in older if number < version]
+        if not older:
+            return None
+        changes = list(models.DirtyNode.objects.filter(
+            version__gt=older[-1], version__lte=version).values_list("version", "model", "object_id"))
+        if {number for number, model, pk in changes} != set(range(older[-1] + 1, version + 1)):
+            return None
+        if any(pk is None for number, model, pk in changes):
+            return None
+        allocation = cls.read(cls.shared_path(year.pk, older[-1]))
+        if allocation is not None:
+            allocation.nodes = dict(allocation.nodes)
+            allocation.refresh({(apps.get_model("recoup", model), pk) for number, model, pk in changes})
+        return allocation
+
+    @staticmethod
+    def keep(path, allocation):
+        _shared.clear()
+        _shared[path] = allocation
+        return allocation
+
+    @classmethod
+    def read(cls, path):
+        """
+        The allocation in a file written by write, with read only nodes
+        """
+        try:
+            columns = map_columns(path)
+        except FileNotFoundError:
+            return None
+        allocation = cls.__new__(cls)
+        allocation.data = {"year": int(columns.pop("year")[0])}
+        divisions, services, costs, estimates = (
+            columns.pop(name).tolist() for name in ("share_division", "share_service", "share_cost", "share_estimate"))
+        allocation.division_services = {
+            (division, service): tuple(kernel.amounts([cost, estimate]))
+            for division, service, cost, estimate in zip(divisions, services, costs, estimates)}
+        allocation.nodes = Nodes(columns, models.GRAPH_MODELS, MONEY)
+        return allocation
+
+    def write(self, path):
+        shares = list(self.division_services.items())
+        columns = dict(
+            Nodes.build(self.nodes, models.GRAPH_MODELS, MONEY), year=np.array([self.data["year"]], dtype=np.int64),
+            share_division=np.array([division for (division, service), share in shares], dtype=np.int64),
+            share_service=np.array([service for (division, service), share in shares], dtype=np.int64),
+            share_cost=kernel.cents(share[0] for key, share in shares),
+            share_estimate=kernel.cents(share[1] for key, share in shares))
+        # Written aside then renamed, readers never see a partial file
+        with open(path + ".tmp", "wb") as f:
+            write_columns(f, columns)
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def from_snapshot(cls, year):
+        allocation = cls.__new__(cls)
+        allocation.data, allocation.nodes, allocation.division_services = {"year": year.pk}, {}, {}
+        for snapshot in models.CostSnapshot.objects.filter(year=year):
+            values = json.loads(snapshot.values)
+            for service, share in values.pop("services", {}).items():
+                allocation.division_services[(snapshot.object_id, int(service))] = tuple(Decimal(value) for value in share)
+            for name in MONEY_VALUES.intersection(values):
+                values[name] = Decimal(values[name])
+            node = allocation.node(apps.get_model("recoup", snapshot.model), snapshot.object_id)
+            node.update(values, cost=snapshot.cost, cost_estimate=snapshot.cost_estimate)
+        return allocation
+
+    def snapshot(self, year):
+        """
+        Unsaved CostSnapshot rows holding every node of the allocation
+        """
+        services = defaultdict(dict)
+        for (division, service), share in self.division_services.items():
+            services[division][service] = [str(value) for value in share]
+        snapshots = []
+        for (model, pk), node in self.nodes.items():
+            if pk is None:
+                continue
+            values = {
+                name: str(value) if isinstance(value, Decimal) else value
+                for name, value in node.items() if name not in ("cost", "cost_estimate")}
+            if model is models.Division:
+                values["services"] = services[pk]
+            snapshots.append(models.CostSnapshot(
+                year=year, model=model._meta.model_name, object_id=pk,
+                cost=node["cost"], cost_estimate=node["cost_estimate"], values=json.dumps(values)))
+        return snapshots
+
+    @staticmethod
+    def empty(model):
+        # Every value the model's precomputed methods read, so objects without
+        # a node (e.g. created after their year was closed) are zero rather
+        # than falling back to querying the live data
+        node = {"cost": Decimal(0), "cost_estimate": Decimal(0)}
+        if model in (models.Division, models.CostCentre):
+            node.update(
+                user_count_percentage=0, system_count=0, system_cost=Decimal(0), system_cost_estimate=Decimal(0))
+        if model is models.Division:
+            node.update(cc_count=0, enduser_cost=Decimal(0), enduser_estimate=Decimal(0))
+        elif model is models.Platform:
+            node.update(system_count=0, system_weight_total=None)
+        elif model is models.EndUserService:
+            node.update(total_user_count=None)
+        return node
+
+    def node(self, model, pk):
+        key = (model, pk)
+        if key not in self.nodes:
+            self.nodes[key] = self.empty(model)
+        return self.nodes[key]
+
+    def lookup(self, model, pk):
+        """
+        The values of a node, without adding it when missing as node does, as
+        read only nodes can't be added to
+        """
+        node = self.nodes.get((model, pk))
+        return self.empty(model) if node is None else node
+
+    def add(self, model, pk, cost, estimate):
+        node = self.node(model, pk)
+        node["cost"] += cost
+        node["cost_estimate"] += estimate
+        return node
+
+    def add_sums(self, model, pks, costs, estimates):
+        """
+        Add arrays of cents to the nodes of a model, summed by pk
+        """
+        keys, groups = np.unique(pks, return_inverse=True)
+        sums = []
+        for values in (costs, estimates):
+            totals = np.zeros(len(keys), dtype=np.int64)
+            np.add.at(totals, groups, values)
+            sums.append(kernel.amounts(totals))
+        for pk, cost, estimate in zip(keys.tolist(), *sums):
+            self.add(model, pk, cost, estimate)
+
+    def compute(self):
+        data = self.data
+        bills = data["bills"]
+        active = bills["active"]
+        for model, field in ((models.Contract, "contract_id"), (models.FinancialYear, "year_id")):
+            self.add_sums(model, bills[field][active], bills["cost"][active], bills["cost_estimate"][active])
+        for split, model, field in (
+                ("enduser_costs", models.EndUserService, "service_id"), ("platform_costs", models.Platform, "platform_id")):
+            costs = data[split]
+            for target, column in ((models.ServicePool, "service_pool_id"), (model, field)):
+                self.add_sums(target, costs[column], costs["cost"], costs["cost_estimate"])
+        self.derive()
+
+    def derive(self, platforms=None, systems=None, services=None, cost_centres=None, divisions=None):
+        """
+        Compute the values that follow from the graph structure, for every node
+        or only for the given sets of pks and the nodes they affect, which are
+        added to the sets. See refresh
+        """
+        data = self.data
+        everything = platforms is None
+        user_counts = dict(data["divisions"].rows())
+
+        def dirty(pks, pk):
+            return everything or pk in pks
+
+        members = defaultdict(list)
+        for service, division in data["service_divisions"].rows():
+            members[service].append(division)
+        if not everything:
+            # A division's user count moves its share of every service it uses
+            services.update(service for division, service in self.division_services if division in divisions)
+            services.update(service for service, pks in members.items() if divisions.intersection(pks))
+            for key in [key for key in self.division_services if key[1] in services]:
+                divisions.add(key[0])
+                del self.division_services[key]
+            for service in services.difference(members):
+                if (models.EndUserService, service) in self.nodes:
+                    self.nodes[(models.EndUserService, service)]["total_user_count"] = None
+
+        # Platform costs are shared by dependent systems in proportion to weighting
+        for system, platform, weighting in data["dependencies"].rows():
+            if dirty(platforms, platform):
+                node = self.node(models.Platform, platform)
+                node["system_count"] += 1
+                node["system_weight_total"] = (node["system_weight_total"] or 0) + weighting
+                if not everything:
+                    systems.add(system)
+        # Each platform's cost is split between its systems to the cent, in one pass for every platform
+        dependencies = data["dependencies"]
+        live = np.array([
+            bool(self.node(models.Platform, pk)["system_weight_total"])
+            for pk in dependencies["platform_id"].tolist()], dtype=bool)
+        system_pks, weightings = dependencies["system_id"][live], dependencies["weighting"][live]
+        weighted = set(system_pks.tolist())
+        platform_keys, platform_groups = np.unique(dependencies["platform_id"][live], return_inverse=True)
+        system_keys, system_groups = np.unique(system_pks, return_inverse=True)
+        system_totals = []
+        for field in ("cost", "cost_estimate"):
+            shares = kernel.apportion(
+                kernel.cents(self.nodes[(models.Platform, pk)][field] for pk in platform_keys.tolist()),
+                platform_groups, weightings, system_pks)
+            totals = np.zeros(len(system_keys), dtype=np.int64)
+            np.add.at(totals, system_groups, shares)
+            system_totals.append(kernel.amounts(totals))
+        system_totals = dict(zip(system_keys.tolist(), zip(*system_totals)))
+        for pk, cost_centre, division in data["systems"].rows():
+            if not dirty(systems, pk):
+                continue
+            cost, estimate = system_totals.get(pk, (Decimal(0), Decimal(0)))
+            self.nodes.pop((models.ITSystem, pk), None)
+            self.add(models.ITSystem, pk, cost, estimate)
+            if not everything:
+                divisions.add(division)
+                if cost_centre is not None:
+                    cost_centres.add(cost_centre)
+
+        # End user services are shared by divisions in proportion to user count, likewise
+        shared = [(service, pk) for service, pks in members.items() if dirty(services, service) for pk in pks]
+        service_index = {}
+        service_groups = [service_index.setdefault(service, len(service_index)) for service, pk in shared]
+        for service in service_index:
+            self.node(models.EndUserService, service)["total_user_count"] = sum(
+                user_counts[pk] for pk in members[service])
+        shares = [
+            kernel.amounts(kernel.apportion(
+                kernel.cents(self.nodes[(models.EndUserService, pk)][field] for pk in service_index), service_groups,
+                [user_counts[pk] for service, pk in shared], [pk for service, pk in shared]))
+            for field in ("cost", "cost_estimate")]
+        for (service, pk), cost, estimate in zip(shared, *shares):
+            self.division_services[(pk, service)] = (cost, estimate)
+            if not everything:
+                divisions.add(pk)
+
+        # Systems roll up to cost centres and divisions, counting only those with dependencies
+        # User count percentages depend on every division, so are always recomputed
+        user_total = sum(user_counts.values())
+        for pk, user_count in data["divisions"].rows():
+            node = self.node(models.Division, pk)
+            node.update(
+                user_count=user_count, user_count_percentage=round(user_count / user_total * 100, 2) if user_total else 0)
+            if dirty(divisions, pk):
+                node.update(
+                    cc_count=0, system_count=0, system_cost=Decimal(0), system_cost_estimate=Decimal(0),
+                    enduser_cost=Decimal(0), enduser_estimate=Decimal(0))
+        for pk, division, user_count in data["cost_centres"].rows():
+            node = self.node(models.CostCentre, pk)
+            node.update(
+                user_count=user_count, user_count_percentage=round(user_count / user_total * 100, 2) if user_total else 0)
+            if dirty(cost_centres, pk):
+                node.update(system_count=0, system_cost=Decimal(0), system_cost_estimate=Decimal(0))
+            if dirty(divisions, division):
+                self.node(models.Division, division)["cc_count"] += 1
+        for pk, cost_centre, division in data["systems"].rows():
+            if pk not in weighted:
+                continue
+            system = self.node(models.ITSystem, pk)
+            parents = [self.node(models.Division, division)] if dirty(divisions, division) else []
+            if cost_centre is not None and dirty(cost_centres, cost_centre):
+                parents.append(self.node(models.CostCentre, cost_centre))
+            for node in parents:
+                node["system_count"] += 1
+                node["system_cost"] += system["cost"]
+                node["system_cost_estimate"] += system["cost_estimate"]
+        for (pk, service), share in self.division_services.items():
+            if dirty(divisions, pk):
+                node = self.node(models.Division, pk)
+                node["enduser_cost"] += share[0]
+                node["enduser_estimate"] += share[1]
+        for pk, user_count in data["divisions"].rows():
+            if dirty(divisions, pk):
+                node = self.node(models.Division, pk)
+                node["cost"] = node["enduser_cost"] + node["system_cost"]
+                node["cost_estimate"] = node["enduser_estimate"] + node["system_cost_estimate"]
+
+    def refresh(self, nodes):
+        """
+        Recompute only the nodes affected by changes to the given (model, pk)
+        nodes, see models.DirtyNode, keeping the values of every other node.
+        Totals are re-read for the changed contracts, service pools, services
+        and platforms only, and derived values for the platforms, systems, cost
+        centres and divisions downstream of them
+        """
+        year = self.data["year"]
+        dirty = defaultdict(set)
+        for model, pk in nodes:
+            if model is not models.FinancialYear or pk == year:
+                dirty[model].add(pk)
+                self.nodes.pop((model, pk), None)
+
+        def add(model, queryset, field):
+            for pk, cost, estimate in queryset.order_by().values_list(field).annotate(Sum("cost"), Sum("cost_estimate")):
+                self.add(model, pk, cost, estimate)
+
+        bills = models.Bill.objects.filter(year=year, active=True)
+        if dirty[models.Contract]:
+            add(models.Contract, bills.filter(contract__in=dirty[models.Contract]), "contract")
+        if dirty[models.FinancialYear]:
+            add(models.FinancialYear, bills, "year")
+        if dirty[models.ServicePool]:
+            # Pools take both kinds of cost split, summed together from their shared table
+            costs = models.Cost.objects.filter(year=year, service_pool__in=dirty[models.ServicePool])
+            add(models.ServicePool, costs, "service_pool")
+        for model, target, field in (
+                (models.EndUserCost, models.EndUserService, "service"), (models.ITPlatformCost, models.Platform, "platform")):
+            costs = model.objects.filter(year=year)
+            if dirty[target]:
+                add(target, costs.filter(**{"{}__in".format(field): dirty[target]}), field)
+        self.data.update(load_structure())
+        self.derive(
+            dirty[models.Platform], dirty[models.ITSystem], dirty[models.EndUserService],
+            dirty[models.CostCentre], dirty[models.Division])
+
+    @property
+    def year(self):
+        return self.lookup(models.FinancialYear, self.data["year"])
+
+    def percentage(self, value, year_value):
+        if year_value == Decimal(0):
+            return 0
+        return round(value / year_value * 100, 2)
+
+    def values(self, obj):
+        """
+        All computed values for a model instance, keyed by model method name
+        """
+        values = dict(self.lookup(type(obj), obj.pk))
+        if isinstance(obj, models.CostSummary):
+            values["cost_percentage"] = self.percentage(values["cost"], self.year["cost"])
+            values["cost_estimate_percentage"] = self.percentage(
+                values["cost_estimate"], self.year["cost_estimate"])
+        return values
+
+    def get(self, obj, name, *default):
+        values = self.values(obj)
+        # Rows created after a year was closed have no snapshot values
+        return values.get(name, *default) if default else values[name]
+
+    def total(self, model, name):
+        """
+        Sum of a computed value across every node of a model
+        """
+        if isinstance(self.nodes, Nodes):
+            return kernel.amounts([self.nodes.total(model, name)])[0]
+        return sum((node[name] for (node_model, pk), node in self.nodes.items() if node_model is model), Decimal(0))
+
+    def service_share(self, division, service):
+        """
+        A division's (cost, estimate) share of an end user service
+        """
+        return self.division_services.get((division.pk, service.pk), (Decimal(0), Decimal(0)))
+
+    def apply(self, objects):
+        """
+        Store computed values on model instances so their cost methods return
+        them without querying, see models.precomputed
+        """
+        for obj in objects:
+            for name, value in self.values(obj).items():
+                setattr(obj, "_{}".format(name), value)
+        return objects
+
+
+def rebuild_cost_totals(check=False):
+    """
+    Compare the stored totals of every CostTotal row with totals computed from
+    scratch, correcting them unless check. Returns (obj, stored, actual) for
+    each one that had drifted
+    """
+    allocation = Allocation(load_data())
+    # Years store their own totals, the other models those of the current year
+    year_totals = {
+        pk: (cost or Decimal(0), estimate or Decimal(0))
+        for pk, cost, estimate in models.Bill.objects.filter(active=True).order_by().values("year").annotate(
+            Sum("cost"), Sum("cost_estimate")).values_list("year", "cost__sum", "cost_estimate__sum")}
+    drifted = []
+    for model in (models.Contract, models.FinancialYear, models.ServicePool, models.EndUserService, models.Platform):
+        for obj in model.objects.all():
+            if model is models.FinancialYear:
+                actual = year_totals.get(obj.pk, (Decimal(0), Decimal(0)))
+            else:
+                actual = (allocation.get(obj, "cost"), allocation.get(obj, "cost_estimate"))
+            stored = (obj.total_cost, obj.total_cost_estimate)
+            if stored == actual:
+                continue
+            drifted.append((obj, stored, actual))
+            if not check:
+                model.objects.filter(pk=obj.pk).update(total_cost=actual[0], total_cost_estimate=actual[1])
+    return drifted
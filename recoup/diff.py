@@ -0,0 +1,222 @@
+from collections import defaultdict, namedtuple
+from decimal import Decimal
+from django.contrib.admin.models import ADDITION, LogEntry
+from django.contrib.contenttypes.models import ContentType
+from django.core import serializers
+from reversion.models import Version
+
+from recoup import models
+from recoup.allocation import Allocation, load_data
+from recoup.graph import Table
+
+ZERO = (Decimal(0), Decimal(0))
+
+
+class Change(namedtuple("Change", ["key", "before", "after"])):
+    """
+    A (cost, cost_estimate) pair before and after
+    """
+    @property
+    def delta(self):
+        return (self.after[0] - self.before[0], self.after[1] - self.before[1])
+
+    @property
+    def size(self):
+        return max(abs(self.delta[0]), abs(self.delta[1]))
+
+
+def changes(before, after):
+    """
+    Changes between two dicts of (cost, cost_estimate) in one pass over their
+    keys, largest first
+    """
+    found = []
+    for key in before.keys() | after.keys():
+        old, new = before.get(key, ZERO), after.get(key, ZERO)
+        if old != new:
+            found.append(Change(key, old, new))
+    return sorted(found, key=lambda change: change.size, reverse=True)
+
+
+class Diff(object):
+    """
+    Differences between two allocations: per node of the cost graph, then per
+    bill and cost split that caused them. Bills are matched by pk within a year
+    and by contract and name across years, as rollover copies them
+    """
+    def __init__(self, before, after, data=None):
+        before_data, after_data = data or (before.data, after.data)
+        across = before.data["year"] != after.data["year"]
+        self.total = Change(None, (before.year["cost"], before.year["cost_estimate"]), (
+            after.year["cost"], after.year["cost_estimate"]))
+        self.nodes = changes(self.node_values(before), self.node_values(after))
+        before_bills, before_splits = self.bill_values(before_data, across)
+        after_bills, after_splits = self.bill_values(after_data, across)
+        self.bills = changes(before_bills, after_bills)
+        self.splits = changes(before_splits, after_splits)
+
+    @staticmethod
+    def node_values(allocation):
+        return {
+            (model, pk): (node["cost"], node["cost_estimate"])
+            for (model, pk), node in allocation.nodes.items() if pk is not None and model is not models.FinancialYear}
+
+    @staticmethod
+    def bill_values(data, across):
+        """
+        (cost, cost_estimate) keyed by bill and by (bill, split type, service
+        pool, service or platform), for matching between the two allocations
+        """
+        keys, bills, splits = {}, defaultdict(lambda: ZERO), defaultdict(lambda: ZERO)
+        for pk, contract, name, year, active, cost, estimate in data["bills"].rows():
+            keys[pk] = (contract, name) if across else pk
+            if active:
+                bills[keys[pk]] = (bills[keys[pk]][0] + cost, bills[keys[pk]][1] + estimate)
+        for split, model in (("enduser_costs", models.EndUserService), ("platform_costs", models.Platform)):
+            for bill, pool, target, cost, estimate in data[split].rows():
+                key = (keys[bill], pool, model, target)
+                splits[key] = (splits[key][0] + cost, splits[key][1] + estimate)
+        return bills, splits
+
+    def top(self, limit=50):
+        """
+        The largest changes of each kind, with labels read in one query per model
+        """
+        nodes, bills, splits = self.nodes[:limit], self.bills[:limit], self.splits[:limit]
+        wanted = defaultdict(set)
+        for change in nodes:
+            wanted[change.key[0]].add(change.key[1])
+        bill_pks = set()
+        for key in [change.key for change in bills] + [change.key[0] for change in splits]:
+            if isinstance(key, tuple):
+                wanted[models.Contract].add(key[0])
+            else:
+                bill_pks.add(key)
+        bill_names = {
+            pk: (contract, name) for pk, contract, name in models.Bill.objects.filter(
+                pk__in=bill_pks).values_list("pk", "contract_id", "name")}
+        wanted[models.Contract].update(contract for contract, name in bill_names.values())
+        for bill, pool, model, target in [change.key for change in splits]:
+            wanted[models.ServicePool].add(pool)
+            wanted[model].add(target)
+        objects = {model: model.objects.in_bulk(list(pks)) for model, pks in wanted.items()}
+
+        def label(model, pk):
+            obj = objects[model].get(pk)
+            return str(obj) if obj is not None else "Deleted {} {}".format(model._meta.verbose_name, pk)
+
+        def bill_label(key):
+            contract, name = key if isinstance(key, tuple) else bill_names.get(key, (None, "deleted bill {}".format(key)))
+            return "{} - {}".format(label(models.Contract, contract), name) if contract else name
+
+        return {
+            "nodes": [(change.key[0]._meta.verbose_name.capitalize(), label(*change.key), change) for change in nodes],
+            "bills": [(bill_label(change.key), change) for change in bills],
+            "splits": [
+                (bill_label(change.key[0]), label(models.ServicePool, change.key[1]), label(*change.key[2:]), change)
+                for change in splits],
+        }
+
+
+def year_diff(before, after):
+    """
+    Compare the allocations of two financial years, as frozen for closed years
+    """
+    return Diff(Allocation.load(before), Allocation.load(after), data=(load_data(before), load_data(after)))
+
+
+def rows_as_of(revision, model, fields, rows):
+    """
+    Rows of a model ({pk: values of fields} as they are now) as they were when
+    a reversion revision was saved, from the latest version of each row changed
+    since. Rows added in the admin since are dropped, rows never saved in the
+    admin are taken as they are now
+    """
+    versions = Version.objects.get_for_model(model)
+    changed = set(versions.filter(revision_id__gt=revision.pk).values_list("object_id", flat=True))
+    earlier = versions.filter(revision_id__lte=revision.pk)
+    deleted = set(earlier.values_list("object_id", flat=True)) - {str(pk) for pk in rows}
+    latest = {}
+    for version in earlier.filter(object_id__in=changed | deleted).order_by("revision_id"):
+        latest[version.object_id] = version
+    added = set(LogEntry.objects.filter(
+        content_type=ContentType.objects.get_for_model(model), action_flag=ADDITION,
+        action_time__gt=revision.date_created).values_list("object_id", flat=True))
+    rows = dict(rows)
+    for object_id in changed | deleted:
+        if object_id in latest:
+            version = latest[object_id]
+            saved = next(serializers.deserialize(version.format, version.serialized_data, ignorenonexistent=True))
+            rows[int(object_id)] = tuple(
+                saved.m2m_data[field] if field in saved.m2m_data else getattr(saved.object, field) for field in fields)
+        elif object_id in added:
+            rows.pop(int(object_id), None)
+    return rows
+
+
+def revision_data(revision, year=None):
+    """
+    load_data for the rows of a financial year (by default the current one) as
+    they were when a reversion revision was saved
+    """
+    year = year or models.FinancialYear.current()
+
+    def rows(model, *fields):
+        return rows_as_of(revision, model, fields, {
+            row[0]: row[1:] for row in model.objects.values_list("pk", *fields)})
+
+    bills = {
+        pk: row for pk, row in rows(
+            models.Bill, "contract_id", "name", "year_id", "active", "cost", "cost_estimate").items()
+        if row[2] == year.pk}
+    # Split amounts are derived on commit, after the revision is saved, so they are derived again from the bills
+    costs = {
+        pk: row for pk, row in rows(models.Cost, "bill_id", "service_pool_id", "percentage").items() if row[0] in bills}
+    cost_items = [
+        models.Cost(pk=pk, bill_id=bill, percentage=percentage) for pk, (bill, pool, percentage) in costs.items()]
+    amounts = models.Cost.split({
+        pk: models.Bill(pk=pk, active=active, cost=cost, cost_estimate=estimate)
+        for pk, (contract, name, year_id, active, cost, estimate) in bills.items()}, cost_items)
+    costs = {item.pk: costs[item.pk][:2] + values for item, values in zip(cost_items, amounts)}
+    members = defaultdict(list)
+    for service, division in models.EndUserService.divisions.through.objects.values_list(
+            "enduserservice_id", "division_id"):
+        members[service].append(division)
+    services = rows_as_of(revision, models.EndUserService, ("divisions",), {
+        pk: (members[pk],) for pk in models.EndUserService.objects.values_list("pk", flat=True)})
+
+    def splits(model, field):
+        return Table(model, ("bill_id", "service_pool_id", field, "cost", "cost_estimate"), [
+            (costs[pk][0], costs[pk][1], target, costs[pk][2], costs[pk][3])
+            for pk, (target,) in rows(model, field).items() if pk in costs])
+
+    def table(model, *fields):
+        return Table(model, ("pk",) + fields, [(pk,) + row for pk, row in rows(model, *fields).items()])
+
+    return {
+        "year": year.pk,
+        "bills": Table(
+            models.Bill, ("pk", "contract_id", "name", "year_id", "active", "cost", "cost_estimate"),
+            [(pk,) + row for pk, row in bills.items()]),
+        "enduser_costs": splits(models.EndUserCost, "service_id"),
+        "platform_costs": splits(models.ITPlatformCost, "platform_id"),
+        "dependencies": Table(
+            models.SystemDependency, ("system_id", "platform_id", "weighting"),
+            rows(models.SystemDependency, "system_id", "platform_id", "weighting").values()),
+        "systems": table(models.ITSystem, "cost_centre_id", "division_id"),
+        "cost_centres": table(models.CostCentre, "division_id", "user_count"),
+        "divisions": table(models.Division, "user_count"),
+        "service_divisions": Table(
+            models.EndUserService.divisions.through, ("enduserservice_id", "division_id"),
+            [(pk, division) for pk, (divisions,) in services.items() for division in divisions]),
+    }
+
+
+def revision_diff(before, after=None, year=None):
+    """
+    Compare the allocations of a financial year (by default the current one)
+    as of two reversion revisions, the second by default being now
+    """
+    before_data = revision_data(before, year)
+    after_data = revision_data(after, year) if after else load_data(year)
+    return Diff(Allocation(before_data), Allocation(after_data))
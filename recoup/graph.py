@@ -0,0 +1,173 @@
+from collections.abc import Mapping
+from django.db import models as fields
+import numpy as np
+
+from recoup import kernel
+
+
+class Table(object):
+    """
+    Rows of a model as parallel NumPy arrays, one per field, built from a
+    values_list() query rather than model instances and addressed by row
+    index, e.g. table["cost"][i]. Money is held as integer cents (see
+    recoup.kernel) and empty foreign keys as 0
+    """
+    __slots__ = ("model", "fields", "columns")
+
+    def __init__(self, model, names, rows):
+        self.model, self.fields = model, tuple(names)
+        values = list(zip(*rows)) or [()] * len(self.fields)
+        self.columns = {name: self.column(self.field(name), column) for name, column in zip(self.fields, values)}
+
+    @classmethod
+    def load(cls, queryset, *names):
+        return cls(queryset.model, names, queryset.values_list(*names))
+
+    def field(self, name):
+        return self.model._meta.pk if name == "pk" else self.model._meta.get_field(name)
+
+    @staticmethod
+    def column(field, values):
+        if isinstance(field, fields.DecimalField):
+            return kernel.cents(values)
+        if isinstance(field, fields.FloatField):
+            return np.array(values, dtype=np.float64)
+        if isinstance(field, fields.BooleanField):
+            return np.array(values, dtype=bool)
+        if isinstance(field, (fields.IntegerField, fields.AutoField, fields.ForeignKey)):
+            return np.array([value or 0 for value in values], dtype=np.int64)
+        return np.array(values, dtype=object)
+
+    def __len__(self):
+        return len(self.columns[self.fields[0]]) if self.fields else 0
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def rows(self, *names):
+        """
+        Tuples of Python values of the given fields (by default all) for every
+        row, with money as Decimal and empty foreign keys as None
+        """
+        columns = []
+        for name in names or self.fields:
+            field, column = self.field(name), self.columns[name]
+            if isinstance(field, fields.DecimalField):
+                columns.append(kernel.amounts(column))
+            elif field.null and isinstance(field, fields.ForeignKey):
+                columns.append([value or None for value in column.tolist()])
+            else:
+                columns.append(column.tolist())
+        return zip(*columns)
+
+
+def write_columns(f, columns):
+    """
+    Write a dict of NumPy arrays to a file, as .npy arrays one after another
+    following one of their names
+    """
+    np.lib.format.write_array(f, np.array(list(columns), dtype=str))
+    for column in columns.values():
+        np.lib.format.write_array(f, np.ascontiguousarray(column))
+
+
+def map_columns(path):
+    """
+    The dict of arrays in a file written by write_columns, memory mapped read
+    only, so that every process reading the file shares the pages holding them
+    """
+    columns = {}
+    with open(path, "rb") as f:
+        for name in np.lib.format.read_array(f).tolist():
+            version = np.lib.format.read_magic(f)
+            read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else (
+                np.lib.format.read_array_header_2_0)
+            shape, fortran, dtype = read_header(f)
+            if not np.prod(shape):
+                columns[name] = np.zeros(shape, dtype=dtype)
+                continue
+            columns[name] = np.memmap(path, dtype=dtype, mode="r", offset=f.tell(), shape=shape)
+            f.seek(f.tell() + columns[name].nbytes)
+    return columns
+
+
+class Nodes(Mapping):
+    """
+    Read only {(model, pk): {name: value}} of allocation graph nodes held as
+    columns of arrays (e.g. from map_columns) rather than dicts: a sorted key
+    per node (its model's index in models and its pk), a column per value name
+    with money in cents, and bits of "present" and "empty" for whether a node
+    has each value and whether it is None
+    """
+    __slots__ = ("columns", "models", "money", "names")
+    PK_BITS = 40
+
+    def __init__(self, columns, models, money):
+        self.columns, self.models, self.money = columns, tuple(models), money
+        self.names = [name for name in columns if name not in ("key", "present", "empty")]
+
+    @classmethod
+    def build(cls, nodes, models, money):
+        """
+        The columns holding a dict of nodes
+        """
+        models = tuple(models)
+        keys = sorted(nodes, key=lambda key: (models.index(key[0]), key[1] or 0))
+        names = sorted({name for node in nodes.values() for name in node})
+        columns = {
+            "key": np.array([models.index(model) << cls.PK_BITS | (pk or 0) for model, pk in keys], dtype=np.int64),
+            "present": np.zeros(len(keys), dtype=np.int64), "empty": np.zeros(len(keys), dtype=np.int64)}
+        for bit, name in enumerate(names):
+            values = [nodes[key].get(name) for key in keys]
+            for flag, rows in (("present", [name in nodes[key] for key in keys]), ("empty", [
+                    value is None for value in values])):
+                columns[flag] |= np.array(rows, dtype=bool).astype(np.int64) << bit
+            if name in money:
+                columns[name] = kernel.cents(value or 0 for value in values)
+            elif all(isinstance(value, int) for value in values if value is not None):
+                columns[name] = np.array([value or 0 for value in values], dtype=np.int64)
+            else:
+                columns[name] = np.array([value or 0 for value in values], dtype=np.float64)
+        return columns
+
+    def index(self, key):
+        model, pk = key
+        if model not in self.models:
+            return None
+        code = self.models.index(model) << self.PK_BITS | (pk or 0)
+        i = int(np.searchsorted(self.columns["key"], code))
+        return i if i < len(self) and self.columns["key"][i] == code else None
+
+    def __getitem__(self, key):
+        i = self.index(key)
+        if i is None:
+            raise KeyError(key)
+        present, empty = int(self.columns["present"][i]), int(self.columns["empty"][i])
+        node = {}
+        for bit, name in enumerate(self.names):
+            if not present >> bit & 1:
+                continue
+            value = self.columns[name][i]
+            node[name] = None if empty >> bit & 1 else kernel.amounts([value])[0] if name in self.money else (
+                value.item())
+        return node
+
+    def __contains__(self, key):
+        return self.index(key) is not None
+
+    def __iter__(self):
+        mask = (1 << self.PK_BITS) - 1
+        for key in self.columns["key"].tolist():
+            yield self.models[key >> self.PK_BITS], key & mask
+
+    def __len__(self):
+        return len(self.columns["key"])
+
+    def total(self, model, name):
+        """
+        Sum of a money value across every node of a model, in cents
+        """
+        if model not in self.models or name not in self.columns:
+            return 0
+        rows = self.columns["key"] >> self.PK_BITS == self.models.index(model)
+        return int(self.columns[name][rows].sum())
@@ -0,0 +1,250 @@
+from datetime import date, datetime
+from decimal import Decimal, InvalidOperation
+from django.core.exceptions import ValidationError
+from django.db import transaction
+import csv
+import io
+import json
+
+from recoup import models
+
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+
+# One row per bill, or per cost split of a bill: rows with the same vendor,
+# reference and bill name add splits to the same bill
+COLUMNS = [
+    "vendor", "reference", "brand", "bill", "description", "comment", "quantity", "renewal_date",
+    "cost", "cost_estimate", "active", "split", "split_name", "percentage", "service_pool", "service", "platform"]
+SPLIT_TYPES = {"end user": models.EndUserCost, "platform": models.ITPlatformCost}
+# One row per cost centre in a user count export
+USER_COUNT_COLUMNS = ["code", "user_count"]
+
+
+def read_rows(name, f, required=("vendor", "bill")):
+    """
+    Rows of a .csv file or the first worksheet of a .xlsx file as dicts keyed
+    by lower cased header
+    """
+    if name.lower().endswith(".xlsx"):
+        if openpyxl is None:
+            raise ValidationError("Importing .xlsx files requires openpyxl, upload a .csv file instead")
+        sheet = openpyxl.load_workbook(f, read_only=True, data_only=True).worksheets[0]
+        rows = sheet.iter_rows(values_only=True)
+    else:
+        rows = csv.reader(io.TextIOWrapper(f, encoding="utf-8-sig", newline=""))
+    header = [str(value or "").strip().lower() for value in next(rows, [])]
+    missing = set(required) - set(header)
+    if missing:
+        raise ValidationError("Missing columns: {}".format(", ".join(sorted(missing))))
+    return [
+        {key: value.strip() if isinstance(value, str) else value for key, value in zip(header, row)}
+        for row in rows if any(value not in (None, "") for value in row)]
+
+
+def lookup(model, field="name"):
+    # Names aren't unique, ambiguous ones map to None
+    objects = {}
+    for obj in model.objects.all():
+        key = getattr(obj, field).lower()
+        objects[key] = None if key in objects else obj
+    return objects
+
+
+class Importer(object):
+    """
+    Validates every row before writing anything, then creates contracts,
+    bills and cost splits with bulk inserts in one transaction
+    """
+    def __init__(self, rows, year):
+        self.rows, self.year = rows, year
+        self.errors = []
+
+    def error(self, line, message):
+        self.errors.append("Row {}: {}".format(line, message))
+
+    def decimal(self, line, row, column, default=Decimal(0)):
+        value = row.get(column)
+        if value in (None, ""):
+            return default
+        try:
+            return Decimal(str(value).replace(",", "").replace("$", ""))
+        except InvalidOperation:
+            self.error(line, "{} is not a number: {}".format(column, value))
+            return default
+
+    def boolean(self, line, row, column, default=True):
+        value = str(row.get(column) if row.get(column) is not None else "").lower()
+        if value == "":
+            return default
+        if value in ("1", "true", "yes", "y"):
+            return True
+        if value in ("0", "false", "no", "n"):
+            return False
+        self.error(line, "{} is not yes or no: {}".format(column, value))
+        return default
+
+    def date(self, line, row, column):
+        value = row.get(column)
+        if value in (None, ""):
+            return None
+        if isinstance(value, datetime):
+            return value.date()
+        if isinstance(value, date):
+            return value
+        try:
+            return datetime.strptime(str(value), "%Y-%m-%d").date()
+        except ValueError:
+            self.error(line, "{} is not a YYYY-MM-DD date: {}".format(column, value))
+
+    def named(self, line, objects, column, value):
+        obj = objects.get(str(value or "").lower())
+        if obj is None:
+            self.error(line, "{} \"{}\" {}".format(
+                column, value or "", "is ambiguous" if str(value or "").lower() in objects else "does not exist"))
+        return obj
+
+    def validate(self):
+        pools, services, platforms = lookup(models.ServicePool), lookup(models.EndUserService), lookup(models.Platform)
+        existing = set(models.Bill.objects.filter(year=self.year).values_list(
+            "contract__vendor", "contract__reference", "name"))
+        self.contracts, self.bills, self.costs = {}, {}, []
+        if self.year.closed:
+            raise ValidationError("The {} financial year is closed".format(self.year))
+        for line, row in enumerate(self.rows, 2):
+            vendor, bill_name = str(row.get("vendor") or ""), str(row.get("bill") or "")
+            reference = str(row.get("reference") or "N/A")
+            if not vendor or not bill_name:
+                self.error(line, "vendor and bill are required")
+                continue
+            if (vendor, reference) not in self.contracts:
+                self.contracts[(vendor, reference)] = models.Contract(
+                    vendor=vendor, reference=reference, brand=str(row.get("brand") or "N/A"))
+            key = (vendor, reference, bill_name)
+            if key in existing:
+                self.error(line, "{} already has a bill {} in {}".format(vendor, bill_name, self.year))
+            if key not in self.bills:
+                self.bills[key] = models.Bill(
+                    name=bill_name, year=self.year,
+                    description=str(row.get("description") or "N/A"), comment=str(row.get("comment") or ""),
+                    quantity=str(row.get("quantity") or "1"), renewal_date=self.date(line, row, "renewal_date"),
+                    cost=self.decimal(line, row, "cost"), cost_estimate=self.decimal(line, row, "cost_estimate"),
+                    active=self.boolean(line, row, "active"))
+            split = str(row.get("split") or "").lower()
+            if not split:
+                continue
+            if split not in SPLIT_TYPES:
+                self.error(line, "split must be one of {}: {}".format(", ".join(SPLIT_TYPES), split))
+                continue
+            percentage = self.decimal(line, row, "percentage")
+            if not 0 <= percentage <= 100:
+                self.error(line, "percentage must be between 0 and 100: {}".format(percentage))
+            cost = SPLIT_TYPES[split](
+                name=str(row.get("split_name") or bill_name), percentage=percentage,
+                service_pool=self.named(line, pools, "service_pool", row.get("service_pool")))
+            if split == "end user":
+                cost.service = self.named(line, services, "service", row.get("service"))
+            else:
+                cost.platform = self.named(line, platforms, "platform", row.get("platform"))
+            self.costs.append((key, cost))
+        if self.errors:
+            raise ValidationError(self.errors)
+
+    def save(self):
+        """
+        Returns the number of contracts, bills and cost splits created
+        """
+        self.validate()
+        with transaction.atomic():
+            contracts = {(c.vendor, c.reference): c for c in models.Contract.objects.all()}
+            new_contracts = [c for key, c in self.contracts.items() if key not in contracts]
+            for contract in models.bulk_insert(models.Contract, new_contracts):
+                contracts[(contract.vendor, contract.reference)] = contract
+            for (vendor, reference, name), bill in self.bills.items():
+                bill.contract = contracts[(vendor, reference)]
+            imported = models.bulk_insert(models.Bill, list(self.bills.values()))
+            for key, cost in self.costs:
+                cost.bill = self.bills[key]
+            models.bulk_create_costs([cost for key, cost in self.costs])
+            # Derive the split costs and move the stored totals once for everything
+            models.recompute_costs(imported)
+            models.update_cost_totals([], [total for bill in imported for total in bill.cost_totals()])
+            models.cost_data_changed()
+        return len(new_contracts), len(self.bills), len(self.costs)
+
+
+def read_user_counts(name, f):
+    """
+    Rows of a user count export: a .json file holding either an object of
+    counts keyed by cost centre code or a list of objects, or a .csv/.xlsx
+    file, each with the USER_COUNT_COLUMNS
+    """
+    if not name.lower().endswith(".json"):
+        return read_rows(name, f, USER_COUNT_COLUMNS)
+    try:
+        data = json.load(io.TextIOWrapper(f, encoding="utf-8-sig"))
+    except ValueError as e:
+        raise ValidationError("Not a JSON file: {}".format(e))
+    if isinstance(data, dict):
+        return [{"code": code, "user_count": count} for code, count in data.items()]
+    if not isinstance(data, list) or not all(isinstance(row, dict) for row in data):
+        raise ValidationError("Expected an object of user counts by code, or a list of objects")
+    return [{str(key).lower(): value for key, value in row.items()} for row in data]
+
+
+class UserCountSync(object):
+    """
+    Brings cost centre user counts in line with an export, writing only the
+    cost centres whose count changed with one bulk update, then re-summing
+    their divisions' counts in one grouped query. Cost centres missing from
+    the export are left alone, codes unknown here are skipped and reported
+    """
+    def __init__(self, rows):
+        self.rows = rows
+        self.errors = []
+
+    def count(self, line, row):
+        value = row.get("user_count")
+        try:
+            count = Decimal(str(value).replace(",", "").strip())
+            if count >= 0 and count == count.to_integral_value():
+                return int(count)
+        except InvalidOperation:
+            pass
+        self.errors.append("Row {}: user_count is not a whole number of users: {}".format(line, value))
+
+    def validate(self):
+        current = {code.lower(): (pk, count) for pk, code, count in models.CostCentre.objects.values_list(
+            "pk", "code", "user_count")}
+        self.changes, self.unknown, seen = {}, [], set()
+        for line, row in enumerate(self.rows, 2):
+            code, count = str(row.get("code") or "").strip(), self.count(line, row)
+            if count is None:
+                continue
+            if not code:
+                self.errors.append("Row {}: code is required".format(line))
+            elif code.lower() in seen:
+                self.errors.append("Row {}: cost centre {} is listed more than once".format(line, code))
+            elif code.lower() not in current:
+                self.unknown.append(code)
+            elif current[code.lower()][1] != count:
+                self.changes[current[code.lower()][0]] = count
+            seen.add(code.lower())
+        if self.errors:
+            raise ValidationError(self.errors)
+
+    def save(self):
+        """
+        Returns the number of cost centres updated and the unknown codes
+        """
+        self.validate()
+        with transaction.atomic():
+            models.update_by_pk(models.CostCentre, {pk: {"user_count": count} for pk, count in self.changes.items()})
+            divisions = set(models.CostCentre.objects.filter(pk__in=list(self.changes)).values_list(
+                "division_id", flat=True))
+            models.update_division_user_counts(divisions)
+            if self.changes:
+                models.cost_data_changed({(models.CostCentre, pk) for pk in self.changes})
+        return len(self.changes), self.unknown
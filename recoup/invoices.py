@@ -0,0 +1,105 @@
+from collections import defaultdict
+from django.core.exceptions import ValidationError
+from django.db import connections
+from django.template.loader import render_to_string
+from django.utils import timezone
+from django.utils.text import slugify
+import copy
+import multiprocessing
+import re
+import zipfile
+
+from recoup import models
+from recoup.allocation import Allocation
+
+
+def invoice_contexts(year, divisions, numbers=None):
+    """
+    bill.html contexts for each of a queryset of divisions in a financial
+    year, all read from one allocation with one query per model. numbers maps
+    division pks to their (invoice number, due date)
+    """
+    allocation = Allocation.load(year)
+    divisions = allocation.apply(list(divisions))
+    pks = [division.pk for division in divisions]
+    services = {service.pk: service for service in models.EndUserService.objects.filter(divisions__in=pks).distinct()}
+    division_services = defaultdict(list)
+    for service, division in models.EndUserService.divisions.through.objects.filter(
+            division__in=pks).values_list("enduserservice_id", "division_id"):
+        division_services[division].append(services[service])
+    order = {pk: i for i, pk in enumerate(services)}
+    systems = defaultdict(list)
+    for system in allocation.apply(list(models.ITSystem.objects.filter(
+            division__in=pks, systemdependency__isnull=False).order_by("cost_centre", "name").distinct().select_related(
+            "cost_centre"))):
+        systems[system.division_id].append(system)
+    created = timezone.localdate()
+    contexts = []
+    for division in divisions:
+        shares = []
+        for service in sorted(division_services[division.pk], key=lambda service: order[service.pk]):
+            # Services are shared between divisions, each invoice shows its own share
+            service = copy.copy(service)
+            service.cost_estimate_display = allocation.service_share(division, service)[1]
+            shares.append(service)
+        number, due = (numbers or {}).get(division.pk, (None, None))
+        contexts.append({
+            "year": year, "division": division, "services": shares, "systems": systems[division.pk],
+            # As of the year, frozen with its costs once it is closed
+            "user_count": allocation.get(division, "user_count", division.user_count),
+            "created": created, "invoice_number": number, "due": due})
+    return contexts
+
+
+def invoice_numbers(first=None, due=None, each=None):
+    """
+    {division pk: (invoice number, due date)} for every division, numbered in
+    order from first by counting up its trailing digits (e.g. INV-0099,
+    INV-0100), with those of each ({division pk: (invoice number, due date)})
+    taking precedence where given. Raises ValidationError if first has no
+    digits to count up, as every division would get the same number
+    """
+    match = re.match(r"^(.*?)(\d+)$", first or "")
+    if first and match is None:
+        raise ValidationError("Invoice number {} must end in digits to number each division from it".format(first))
+    numbers = {}
+    for i, pk in enumerate(models.Division.objects.values_list("pk", flat=True)):
+        number = None
+        if match:
+            prefix, digits = match.groups()
+            number = prefix + str(int(digits) + i).zfill(len(digits))
+        given = (each or {}).get(pk, (None, None))
+        numbers[pk] = (given[0] or number, given[1] or due)
+    return numbers
+
+
+def render_invoice(context):
+    return render_to_string("bill.html", context)
+
+
+def render_invoices(contexts, processes=1):
+    """
+    Render invoices in this process or, for batches outside a request,
+    concurrently across a pool of forked processes (processes=None for one
+    per CPU)
+    """
+    if processes == 1 or len(contexts) < 2:
+        return [render_invoice(context) for context in contexts]
+    # Forked processes mustn't share the connection, it reopens when next used
+    connections.close_all()
+    with multiprocessing.Pool(processes) as pool:
+        return pool.map(render_invoice, contexts)
+
+
+def invoice_zip(output, year, numbers=None, processes=1):
+    """
+    Write the invoices of every division in a financial year to a ZIP file,
+    one HTML file each, rendered as by render_invoices
+    """
+    contexts = invoice_contexts(year, models.Division.objects.all(), numbers)
+    with zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED) as archive:
+        for context, html in zip(contexts, render_invoices(contexts, processes)):
+            division = context["division"]
+            name = "{}-{}".format(context["invoice_number"] or division.position, slugify(division.name))
+            archive.writestr("{}.html".format(name), html)
+    return output
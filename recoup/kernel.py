@@ -0,0 +1,57 @@
+from decimal import Decimal
+import numpy as np
+
+
+def cents(amounts):
+    """
+    An array of the integer cents of an iterable of amounts
+    """
+    return np.array([int(Decimal(amount).scaleb(2).to_integral_value()) for amount in amounts], dtype=np.int64)
+
+
+def amounts(cents):
+    """
+    Decimal amounts of an array of integer cents
+    """
+    return [Decimal(int(value)).scaleb(-2) for value in cents]
+
+
+def apportion(totals, groups, weights, keys=None):
+    """
+    Split each of totals (integer cents) between the parts whose entry in
+    groups indexes it, in proportion to their weights, by the largest
+    remainder method: parts are rounded down, then the cents still missing go
+    one each to the parts with the largest remainders, ties going to the
+    lowest key (by default the part's index). The parts of a group add up to
+    its total exactly, or are 0 when its weights add up to 0
+    """
+    totals = np.asarray(totals, dtype=np.int64)
+    groups = np.asarray(groups, dtype=np.intp)
+    weights = np.asarray(weights, dtype=np.float64)
+    keys = np.arange(len(groups)) if keys is None else np.asarray(keys)
+    if not len(groups):
+        return np.zeros(0, dtype=np.int64)
+    weight_totals = np.bincount(groups, weights=weights, minlength=len(totals))
+    valid = weight_totals[groups] != 0
+    exact = np.zeros(len(groups))
+    exact[valid] = totals[groups][valid] * weights[valid] / weight_totals[groups][valid]
+    parts = np.floor(exact).astype(np.int64)
+    missing = totals - np.bincount(groups, weights=parts, minlength=len(totals)).astype(np.int64)
+    missing[weight_totals == 0] = 0
+    # Rank the parts of each group by remainder, largest first
+    order = np.lexsort((keys, parts - exact, groups))
+    starts = np.searchsorted(groups[order], np.arange(len(totals)))
+    rank = np.empty(len(groups), dtype=np.int64)
+    rank[order] = np.arange(len(groups)) - starts[groups[order]]
+    parts += rank < missing[groups]
+    # Float error can leave a group a cent over, taken back from the smallest remainders
+    counts = np.bincount(groups, minlength=len(totals))
+    parts -= counts[groups] - 1 - rank < -missing[groups]
+    return parts
+
+
+def share(amount, weights, index, keys=None):
+    """
+    The part at index of an amount split by weights, see apportion
+    """
+    return amounts(apportion(cents([amount]), np.zeros(len(weights), dtype=np.intp), weights, keys))[index]
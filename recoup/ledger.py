@@ -0,0 +1,191 @@
+from collections import Counter, defaultdict
+from django.db import connection, transaction
+import numpy as np
+
+from recoup import kernel, models
+from recoup.allocation import load_structure
+from recoup.graph import Table
+
+# LedgerEntry values compared by check
+FIELDS = (
+    "split_id", "bill_id", "contract_id", "vendor", "service_pool_id", "platform_id", "service_id", "system_id",
+    "cost_centre_id", "division_id", "cost", "cost_estimate")
+
+
+def shares(costs, field, recipients):
+    """
+    Split each row of a Table of cost splits, ordered by field, between the
+    recipients of its target ({target pk: [(recipient pk, weight)]}) as
+    recoup.allocation does the targets' totals. The running total of each
+    target's splits is apportioned, and each split gets the difference from
+    the one before, so a target's splits add up to the allocation's shares of
+    it to the cent as well as each split to its own amount. Yields (row index,
+    recipient pk or None for what no recipient takes, cost, estimate) in cents
+    """
+    targets = costs[field].tolist()
+    index = {target: i for i, target in enumerate(recipients)}
+    keys = np.array([pk for target in recipients for pk, weight in recipients[target]], dtype=np.int64)
+    weights = np.array([weight for target in recipients for pk, weight in recipients[target]], dtype=np.float64)
+    counts = np.array([len(recipients[target]) for target in recipients] + [0], dtype=np.int64)
+    starts = np.cumsum(counts) - counts
+    split_targets = np.array([index.get(target, len(recipients)) for target in targets], dtype=np.int64)
+    split_counts = counts[split_targets]
+    # One part per split and recipient of its target
+    groups = np.repeat(np.arange(len(targets)), split_counts)
+    positions = np.arange(len(groups)) - np.repeat(np.cumsum(split_counts) - split_counts, split_counts)
+    parts = np.repeat(starts[split_targets], split_counts) + positions
+    first = np.ones(len(targets), dtype=bool)
+    first[1:] = costs[field][1:] != costs[field][:-1]
+    values = []
+    for name in ("cost", "cost_estimate"):
+        amounts = costs[name]
+        totals = np.cumsum(amounts)
+        running = totals - (totals - amounts)[np.maximum.accumulate(np.where(first, np.arange(len(targets)), 0))]
+        allocated = kernel.apportion(running, groups, weights[parts], keys[parts])
+        previous = np.zeros(len(groups), dtype=np.int64)
+        later = ~first[groups]
+        previous[later] = allocated[np.arange(len(groups))[later] - split_counts[groups][later]]
+        allocated -= previous
+        unallocated = amounts - np.bincount(groups, weights=allocated, minlength=len(targets)).astype(np.int64)
+        values.append((allocated, unallocated))
+    (cost_parts, cost_left), (estimate_parts, estimate_left) = values
+    for row, key, cost, estimate in zip(
+            groups.tolist(), keys[parts].tolist(), cost_parts.tolist(), estimate_parts.tolist()):
+        if cost or estimate:
+            yield row, key, cost, estimate
+    for row, (cost, estimate) in enumerate(zip(cost_left.tolist(), estimate_left.tolist())):
+        if cost or estimate:
+            yield row, None, cost, estimate
+
+
+def entries(year, platforms=None, services=None, data=None):
+    """
+    Unsaved LedgerEntry rows of a financial year, for the cost splits of every
+    platform and end user service or only those of the given sets of pks.
+    data is the graph structure from allocation.load_structure
+    """
+    data = data or load_structure()
+    bills = {
+        pk: (contract, vendor)
+        for pk, contract, vendor in models.Bill.objects.filter(year=year).values_list(
+            "pk", "contract_id", "contract__vendor")}
+    systems = {pk: (cost_centre, division) for pk, cost_centre, division in data["systems"].rows()}
+    dependencies = defaultdict(list)
+    for system, platform, weighting in data["dependencies"].rows():
+        dependencies[platform].append((system, weighting))
+    user_counts = dict(data["divisions"].rows())
+    members = defaultdict(list)
+    for service, division in data["service_divisions"].rows():
+        members[service].append((division, user_counts[division]))
+    rows = []
+    for model, field, recipients, pks in (
+            (models.ITPlatformCost, "platform_id", dependencies, platforms),
+            (models.EndUserCost, "service_id", members, services)):
+        splits = model.objects.filter(year=year)
+        if pks is not None:
+            splits = splits.filter(**{"{}__in".format(field): pks})
+        costs = Table.load(
+            splits.order_by(field, "pk"), "pk", "bill_id", "service_pool_id", field, "cost", "cost_estimate")
+        values = list(costs.rows("pk", "bill_id", "service_pool_id", field))
+        for row, key, cost, estimate in shares(costs, field, recipients):
+            split, bill, service_pool, target = values[row]
+            entry = models.LedgerEntry(
+                year=year, split_id=split, bill_id=bill, contract_id=bills[bill][0], vendor=bills[bill][1],
+                service_pool_id=service_pool, cost=kernel.amounts([cost])[0],
+                cost_estimate=kernel.amounts([estimate])[0], **{field: target})
+            if key is not None and model is models.ITPlatformCost:
+                entry.system_id = key
+                entry.cost_centre_id, entry.division_id = systems[key]
+            elif key is not None:
+                entry.division_id = key
+            rows.append(entry)
+    return rows
+
+
+def insert(entries):
+    """
+    Insert unsaved LedgerEntry rows with one executemany, as their values
+    need no preparing for the database the way bulk_create prepares each
+    """
+    fields = [field for field in models.LedgerEntry._meta.concrete_fields if not field.primary_key]
+    quote = connection.ops.quote_name
+    with connection.cursor() as cursor:
+        cursor.executemany("INSERT INTO {} ({}) VALUES ({})".format(
+            quote(models.LedgerEntry._meta.db_table), ", ".join(quote(field.column) for field in fields),
+            ", ".join(["%s"] * len(fields))), [[getattr(entry, field.attname) for field in fields] for entry in entries])
+
+
+def delete(year, platforms=None, services=None):
+    """
+    Delete the LedgerEntry rows of a financial year, or only those of the
+    given sets of platform and end user service pks, with one DELETE, where
+    QuerySet.delete() would fetch every row for the delete signals
+    recoup.models connects to all models
+    """
+    quote = connection.ops.quote_name
+    columns = {field.name: quote(field.column) for field in models.LedgerEntry._meta.concrete_fields}
+    sql = "DELETE FROM {} WHERE {} = %s".format(quote(models.LedgerEntry._meta.db_table), columns["year"])
+    params = [year.pk]
+    if platforms is not None:
+        conditions = []
+        for name, pks in (("platform", platforms), ("service", services)):
+            pks = list(pks or ())
+            if pks:
+                conditions.append("{} IN ({})".format(columns[name], ", ".join(["%s"] * len(pks))))
+                params.extend(pks)
+        if not conditions:
+            return
+        sql += " AND ({})".format(" OR ".join(conditions))
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+
+
+def rebuild(platforms=None, services=None):
+    """
+    Replace the LedgerEntry rows of every open financial year, or only those
+    of the given sets of platform and end user service pks. Closed years keep
+    theirs, as their CostSnapshots do
+    """
+    data = load_structure()
+    with transaction.atomic():
+        for year in models.FinancialYear.objects.filter(closed__isnull=True):
+            delete(year, platforms, services)
+            insert(entries(year, platforms, services, data))
+
+
+def update(nodes):
+    """
+    Rebuild the ledger rows affected by changes to the given (model, pk)
+    allocation graph nodes, or every row when they include None. See
+    models.cost_data_changed
+    """
+    if None in nodes:
+        return rebuild()
+    dirty = defaultdict(set)
+    for model, pk in nodes:
+        dirty[model].add(pk)
+    # A system's rows follow its cost centre and division, a service's divisions' their user counts
+    platforms = dirty[models.Platform].union(models.SystemDependency.objects.filter(
+        system__in=dirty[models.ITSystem]).values_list("platform_id", flat=True))
+    services = dirty[models.EndUserService].union(models.EndUserService.divisions.through.objects.filter(
+        division__in=dirty[models.Division]).values_list("enduserservice_id", flat=True))
+    if platforms or services:
+        rebuild(platforms, services)
+    for pk, vendor in models.Contract.objects.filter(pk__in=dirty[models.Contract]).values_list("pk", "vendor"):
+        models.LedgerEntry.objects.filter(contract=pk).exclude(vendor=vendor).update(vendor=vendor)
+
+
+def check():
+    """
+    Compare the stored LedgerEntry rows of every open financial year with rows
+    built from scratch. Returns (year, missing, stale) for each that differs,
+    the rows not stored and those stored but no longer built
+    """
+    data = load_structure()
+    drifted = []
+    for year in models.FinancialYear.objects.filter(closed__isnull=True):
+        stored = Counter(models.LedgerEntry.objects.filter(year=year).values_list(*FIELDS))
+        built = Counter(tuple(getattr(entry, name) for name in FIELDS) for entry in entries(year, data=data))
+        if stored != built:
+            drifted.append((year, built - stored, stored - built))
+    return drifted
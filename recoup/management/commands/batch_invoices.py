@@ -0,0 +1,48 @@
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+
+from recoup import models
+from recoup.imports import read_rows
+from recoup.invoices import invoice_numbers, invoice_zip
+
+
+class Command(BaseCommand):
+    help = "Writes every division's invoice for a financial year to a ZIP file, rendered in parallel"
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="The .zip file to write")
+        parser.add_argument("--year", type=int, help="Start year of the financial year (default the current one)")
+        parser.add_argument("--invoiceno", help="Invoice number of the first division, later ones counting up from it")
+        parser.add_argument("--due", help="Due date of every invoice")
+        parser.add_argument(
+            "--invoices", help="A .csv or .xlsx file of division, invoice_number and due columns, by division name")
+        parser.add_argument("--processes", type=int, help="Processes to render with (default one per CPU)")
+
+    def handle(self, *args, **options):
+        if options["year"]:
+            year = models.FinancialYear.objects.filter(start__year=options["year"]).first()
+        else:
+            year = models.FinancialYear.current()
+        if year is None:
+            raise CommandError("No such financial year")
+        each = {}
+        if options["invoices"]:
+            divisions = {name.lower(): pk for pk, name in models.Division.objects.values_list("pk", "name")}
+            try:
+                with open(options["invoices"], "rb") as f:
+                    rows = read_rows(options["invoices"], f, ("division",))
+            except ValidationError as e:
+                raise CommandError("\n".join(e.messages))
+            for line, row in enumerate(rows, 2):
+                name = str(row.get("division") or "")
+                if name.lower() not in divisions:
+                    raise CommandError("Row {}: division \"{}\" does not exist".format(line, name))
+                each[divisions[name.lower()]] = (
+                    str(row.get("invoice_number") or "") or None, str(row.get("due") or "") or None)
+        try:
+            numbers = invoice_numbers(options["invoiceno"], options["due"], each)
+        except ValidationError as e:
+            raise CommandError("\n".join(e.messages))
+        with open(options["path"], "wb") as output:
+            invoice_zip(output, year, numbers, options["processes"])
+        self.stdout.write("Wrote {} invoices for {} to {}".format(len(numbers), year, options["path"]))
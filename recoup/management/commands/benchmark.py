@@ -0,0 +1,113 @@
+from django.contrib import admin
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, setup_test_environment, teardown_test_environment
+from django.urls import reverse
+import io
+import json
+import statistics
+import time
+
+from recoup import models
+from recoup.reports import duc_report
+
+
+class Command(BaseCommand):
+    help = (
+        "Times the read views, report, admin changelists and Bill.save() and prints the results as JSON. "
+        "It commits writes, so only run it against a database filled by generate_data")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--repeat", type=int, default=5, help="Number of timed runs of each target")
+        parser.add_argument("--output", help="Write the JSON results to this file instead of stdout")
+        parser.add_argument(
+            "--allow-writes", action="store_true",
+            help="Confirm the database is a throwaway one, as bills are saved and a user created")
+
+    def measure(self, target, repeat):
+        # The first run warms caches and is not timed
+        target()
+        timings, queries = [], []
+        for i in range(repeat):
+            with CaptureQueriesContext(connection) as captured:
+                start = time.perf_counter()
+                target()
+                timings.append((time.perf_counter() - start) * 1000)
+            queries.append(len(captured))
+        return {
+            "median_ms": round(statistics.median(timings), 2),
+            "min_ms": round(min(timings), 2),
+            "max_ms": round(max(timings), 2),
+            "queries": max(queries),
+        }
+
+    def get(self, client, url):
+        def target():
+            response = client.get(url)
+            if response.status_code != 200:
+                raise CommandError("GET {} returned {}".format(url, response.status_code))
+        return target
+
+    def save_bill(self, bill):
+        estimate = bill.cost_estimate
+
+        def target():
+            # Committed, so the work run on commit (see recoup.propagation) is timed with the save
+            with transaction.atomic():
+                bill.cost_estimate += 1
+                bill.save()
+
+        def restore():
+            bill.cost_estimate = estimate
+            bill.save()
+        self.cleanups.append(restore)
+        return target
+
+    def targets(self, client):
+        division = models.Division.objects.first()
+        bill = models.Bill.objects.filter(active=True, cost_items__isnull=False).first()
+        if division is None or bill is None:
+            raise CommandError("No data to benchmark, see the generate_data command")
+        targets = [
+            ("HomePageView", self.get(client, "/")),
+            ("BillView", self.get(client, "/bill?division={}".format(division.pk))),
+            ("DUCReport", lambda: duc_report(io.BytesIO())),
+        ]
+        for model in admin.site._registry:
+            if model._meta.app_label == "recoup":
+                url = reverse("admin:{}_{}_changelist".format(model._meta.app_label, model._meta.model_name))
+                targets.append(("admin:{}".format(model._meta.model_name), self.get(client, url)))
+        targets.append(("Bill.save", self.save_bill(bill)))
+        return targets
+
+    def handle(self, *args, **options):
+        if not options["allow_writes"]:
+            raise CommandError(
+                "The benchmark commits bill changes (moving the data version, ledger and reports on) "
+                "and creates a user. Run it with --allow-writes against a database filled by generate_data")
+        setup_test_environment()
+        results = {}
+        # Saves are committed rather than rolled back, so the user is deleted and the saved bill restored
+        # after. One left behind by a run killed before then is reused
+        user, created = get_user_model().objects.update_or_create(username="benchmark", defaults=dict(
+            email="benchmark@example.com", password=make_password(None), is_staff=True, is_superuser=True))
+        self.cleanups = [user.delete]
+        try:
+            client = Client()
+            client.force_login(user)
+            for name, target in self.targets(client):
+                results[name] = self.measure(target, options["repeat"])
+                self.stderr.write("{}: {median_ms} ms, {queries} queries".format(name, **results[name]))
+        finally:
+            for cleanup in reversed(self.cleanups):
+                cleanup()
+            teardown_test_environment()
+        output = json.dumps(results, indent=2, sort_keys=True)
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                f.write(output)
+        else:
+            self.stdout.write(output)
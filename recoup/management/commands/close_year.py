@@ -0,0 +1,26 @@
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+
+from recoup import models
+
+
+class Command(BaseCommand):
+    help = "Freezes the computed costs of a financial year, so reports on it read a snapshot"
+
+    def add_arguments(self, parser):
+        parser.add_argument("year", type=int, help="Start year of the financial year")
+        parser.add_argument("--reopen", action="store_true", help="Discard the snapshot and allow changes again")
+
+    def handle(self, *args, **options):
+        year = models.FinancialYear.objects.filter(start__year=options["year"]).first()
+        if year is None:
+            raise CommandError("No such financial year")
+        if options["reopen"]:
+            year.reopen()
+            self.stdout.write("Reopened {}".format(year))
+            return
+        try:
+            year.close()
+        except ValidationError as e:
+            raise CommandError("\n".join(e.messages))
+        self.stdout.write("Closed {} with {} cost snapshots".format(year, year.snapshots.count()))
@@ -0,0 +1,125 @@
+from datetime import date
+from decimal import Decimal
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+import io
+import random
+
+from recoup import models
+
+# Rows generated at --scale 1
+BASE_COUNTS = {
+    "divisions": 8,
+    "cost_centres": 120,
+    "systems": 2000,
+    "platforms": 60,
+    "services": 12,
+    "pools": 4,
+    "contracts": 150,
+    "bills": 1000,
+}
+
+
+class Command(BaseCommand):
+    help = "Fills an empty database with a synthetic dataset for benchmarking"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--scale", type=float, default=1, help="Multiplier applied to the default row counts")
+        parser.add_argument("--seed", type=int, default=0, help="Random seed, the same seed gives the same data")
+        parser.add_argument("--inactive", type=float, default=0.1, help="Fraction of bills that are inactive")
+        for name, count in BASE_COUNTS.items():
+            parser.add_argument(
+                "--{}".format(name.replace("_", "-")), type=int, dest=name,
+                help="Number of {} (default {} times scale)".format(name.replace("_", " "), count))
+
+    def counts(self, options):
+        counts = {}
+        for name, count in BASE_COUNTS.items():
+            counts[name] = options[name] if options[name] is not None else max(1, int(count * options["scale"]))
+        if counts["systems"] > 10000:
+            raise CommandError("System ids are four digits, so at most 10000 systems can be generated")
+        return counts
+
+    def handle(self, *args, **options):
+        if models.Division.objects.exists() or models.Bill.objects.exists():
+            raise CommandError("The database already has cost data, generate into an empty database")
+        counts = self.counts(options)
+        rand = random.Random(options["seed"])
+        with transaction.atomic():
+            self.generate(rand, counts, options["inactive"])
+            # Bulk created bills skip the hooks that maintain the stored totals
+            call_command("rebuild_cost_totals", stdout=io.StringIO())
+            models.cost_data_changed()
+        self.stdout.write("Generated {}".format(", ".join("{} {}".format(count, name) for name, count in counts.items())))
+
+    def generate(self, rand, counts, inactive):
+        today = date.today()
+        start = date(today.year if today.month >= 7 else today.year - 1, 7, 1)
+        year = models.FinancialYear.objects.create(start=start, end=date(start.year + 1, 6, 30), is_current=True)
+
+        pools = [models.ServicePool.objects.get_or_create(name="Pool {}".format(i))[0] for i in range(counts["pools"])]
+        # Rows are read back after bulk_create, which only sets primary keys on PostgreSQL
+        models.Division.objects.bulk_create(
+            models.Division(name="Division {}".format(i), position=i) for i in range(counts["divisions"]))
+        divisions = list(models.Division.objects.all())
+        models.CostCentre.objects.bulk_create(
+            models.CostCentre(
+                name="Cost Centre {}".format(i), code="CC{:04d}".format(i),
+                division=rand.choice(divisions), user_count=rand.randint(1, 400))
+            for i in range(counts["cost_centres"]))
+        cost_centres = list(models.CostCentre.objects.all())
+        for division in divisions:
+            division.user_count = sum(cc.user_count for cc in cost_centres if cc.division_id == division.pk)
+            division.save()
+
+        models.Platform.objects.bulk_create(
+            models.Platform(name="Platform {}".format(i)) for i in range(counts["platforms"]))
+        platforms = list(models.Platform.objects.all())
+        systems = []
+        for i in range(counts["systems"]):
+            cost_centre = rand.choice(cost_centres)
+            systems.append(models.ITSystem(
+                system_id="{:04d}".format(i), name="System {}".format(i),
+                cost_centre=cost_centre, division_id=cost_centre.division_id))
+        models.ITSystem.objects.bulk_create(systems)
+        systems = list(models.ITSystem.objects.all())
+        models.SystemDependency.objects.bulk_create(
+            models.SystemDependency(system=system, platform=platform, weighting=rand.choice((0.5, 1, 1, 2, 3)))
+            for system in systems
+            for platform in rand.sample(platforms, min(len(platforms), rand.randint(0, 4))))
+        services = []
+        for i in range(counts["services"]):
+            service = models.EndUserService.objects.create(name="Service {}".format(i))
+            service.divisions.set(rand.sample(divisions, rand.randint(1, len(divisions))))
+            services.append(service)
+
+        models.Contract.objects.bulk_create(
+            models.Contract(
+                vendor="Vendor {}".format(i), brand="Brand {}".format(i % 40),
+                reference="REF-{:05d}".format(i), start=start)
+            for i in range(counts["contracts"]))
+        contracts = list(models.Contract.objects.all())
+        models.Bill.objects.bulk_create(
+            models.Bill(
+                contract=rand.choice(contracts), name="Bill {}".format(i), year=year,
+                cost=Decimal(rand.randint(10000, 50000000)) / 100,
+                cost_estimate=Decimal(rand.randint(10000, 50000000)) / 100,
+                active=rand.random() >= inactive)
+            for i in range(counts["bills"]))
+        bills = list(models.Bill.objects.all())
+
+        # Splits go through save() so their costs are derived from the bill
+        for bill in bills:
+            remaining = Decimal(100)
+            for i in range(rand.randint(0, 4)):
+                percentage = min(remaining, Decimal(rand.randint(100, 5000)) / 100)
+                remaining -= percentage
+                if rand.random() < 0.4:
+                    models.EndUserCost.objects.create(
+                        name="End user split {}".format(i), bill=bill, percentage=percentage,
+                        service_pool=rand.choice(pools), service=rand.choice(services))
+                else:
+                    models.ITPlatformCost.objects.create(
+                        name="Platform split {}".format(i), bill=bill, percentage=percentage,
+                        service_pool=rand.choice(pools), platform=rand.choice(platforms))
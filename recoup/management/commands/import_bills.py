@@ -0,0 +1,34 @@
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+
+from recoup import models
+from recoup.imports import COLUMNS, Importer, read_rows
+
+
+class Command(BaseCommand):
+    help = "Imports contracts, bills and cost splits from a .csv or .xlsx file with the columns: {}".format(
+        ", ".join(COLUMNS))
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="The .csv or .xlsx file to import")
+        parser.add_argument("--year", type=int, help="Start year of the financial year the bills belong to (default the current one)")
+        parser.add_argument("--dry-run", action="store_true", help="Validate the file without importing it")
+
+    def handle(self, *args, **options):
+        if options["year"]:
+            year = models.FinancialYear.objects.filter(start__year=options["year"]).first()
+        else:
+            year = models.FinancialYear.current()
+        if year is None:
+            raise CommandError("No such financial year")
+        try:
+            with open(options["path"], "rb") as f:
+                importer = Importer(read_rows(options["path"], f), year)
+            if options["dry_run"]:
+                importer.validate()
+                self.stdout.write("{} rows are valid".format(len(importer.rows)))
+                return
+            contracts, bills, costs = importer.save()
+        except ValidationError as e:
+            raise CommandError("\n".join(e.messages))
+        self.stdout.write("Imported {} contracts, {} bills and {} cost splits into {}".format(contracts, bills, costs, year))
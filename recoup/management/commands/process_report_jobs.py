@@ -0,0 +1,57 @@
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+import logging
+import time
+import traceback
+
+from recoup import memo, models
+from recoup.reports import build_report
+
+LOGGER = logging.getLogger('recoup')
+
+
+class Command(BaseCommand):
+    help = "Generates queued reports in the background"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--once", action="store_true", help="Exit once the queue is empty")
+        parser.add_argument("--interval", type=float, default=5, help="Seconds to wait between polls of an empty queue")
+
+    def claim(self):
+        requeued = models.ReportJob.requeue_stale()
+        if requeued:
+            LOGGER.warning("Queued {} stale report jobs again".format(requeued))
+        with transaction.atomic():
+            job = models.ReportJob.objects.select_for_update(skip_locked=True).filter(
+                status=models.ReportJob.QUEUED).first()
+            if job is None:
+                return None
+            # Key the artifact by the data it is actually built from
+            job.status, job.started, job.version = models.ReportJob.RUNNING, timezone.now(), models.DataVersion.current()
+            job.save()
+        return job
+
+    def run(self, job):
+        try:
+            with memo.scope():
+                build_report(job)
+        except Exception:
+            LOGGER.exception("Report job {} failed".format(job.pk))
+            job.status, job.error = models.ReportJob.FAILED, traceback.format_exc()
+        else:
+            job.status = models.ReportJob.DONE
+        job.finished = timezone.now()
+        job.save()
+        self.stdout.write("Report job {} finished: {}".format(job.pk, job))
+
+    def handle(self, *args, **options):
+        while True:
+            close_old_connections()
+            job = self.claim()
+            if job is not None:
+                self.run(job)
+            elif options["once"]:
+                break
+            else:
+                time.sleep(options["interval"])
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from recoup import models
+from recoup.allocation import rebuild_cost_totals
+
+
+class Command(BaseCommand):
+    help = "Recalculates the stored cost totals of contracts, years, service pools, services and platforms"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--check", action="store_true",
+            help="Report totals that have drifted from their bills and costs without fixing them")
+        parser.add_argument(
+            "--costs", action="store_true",
+            help="Re-derive every cost split from its bill before rebuilding totals")
+
+    def handle(self, *args, **options):
+        changed = []
+        with transaction.atomic():
+            if options["costs"] and not options["check"]:
+                changed = models.recompute_costs(models.Bill.objects.all())
+                self.stdout.write("{} cost splits re-derived".format(len(changed)))
+            drifted = rebuild_cost_totals(check=options["check"])
+            if not options["check"] and (drifted or changed):
+                # Corrections are written without hooks, so anything derived from the data is stale
+                models.cost_data_changed()
+        for obj, stored, actual in drifted:
+            self.stdout.write("{} {}: stored {}/{}, actual {}/{}".format(
+                obj._meta.verbose_name, obj, stored[0], stored[1], actual[0], actual[1]))
+        if options["check"] and drifted:
+            raise CommandError("{} cost totals have drifted".format(len(drifted)))
+        self.stdout.write("{} cost totals {}".format(len(drifted), "drifted" if options["check"] else "rebuilt"))
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from recoup import ledger, models
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the allocation ledger of every open financial year from its bills and costs"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--check", action="store_true", help="Report years whose ledger has drifted without rebuilding it")
+
+    def handle(self, *args, **options):
+        if not options["check"]:
+            ledger.rebuild()
+            self.stdout.write("{} ledger entries rebuilt".format(models.LedgerEntry.objects.filter(
+                year__closed__isnull=True).count()))
+            return
+        drifted = ledger.check()
+        for year, missing, stale in drifted:
+            self.stdout.write("{}: {} entries missing, {} stale".format(
+                year, sum(missing.values()), sum(stale.values())))
+        if drifted:
+            raise CommandError("The ledger of {} financial years has drifted".format(len(drifted)))
+        self.stdout.write("Ledger up to date")
@@ -0,0 +1,29 @@
+from decimal import Decimal
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+
+from recoup import models
+
+
+class Command(BaseCommand):
+    help = "Starts the next financial year with a copy of the active bills and cost splits of the latest one"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--year", type=int, help="Start year of the financial year to copy (default the latest)")
+        parser.add_argument("--make-current", action="store_true", help="Report on the new year by default")
+        parser.add_argument("--uplift", type=Decimal, default=Decimal(0), help="Percentage increase applied to cost estimates")
+
+    def handle(self, *args, **options):
+        if options["year"]:
+            year = models.FinancialYear.objects.filter(start__year=options["year"]).first()
+        else:
+            year = models.FinancialYear.objects.last()
+        if year is None:
+            raise CommandError("No such financial year")
+        try:
+            new_year = year.rollover(options["uplift"])
+        except ValidationError as e:
+            raise CommandError("\n".join(e.messages))
+        if options["make_current"]:
+            new_year.make_current()
+        self.stdout.write("Created {} with {} bills copied from {}".format(new_year, new_year.bill_set.count(), year))
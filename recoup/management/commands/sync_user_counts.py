@@ -0,0 +1,28 @@
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+
+from recoup.imports import USER_COUNT_COLUMNS, UserCountSync, read_user_counts
+
+
+class Command(BaseCommand):
+    help = "Updates cost centre user counts from a .json, .csv or .xlsx export with the columns: {}".format(
+        ", ".join(USER_COUNT_COLUMNS))
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="The export to sync from")
+        parser.add_argument("--dry-run", action="store_true", help="List the changes without applying them")
+
+    def handle(self, *args, **options):
+        try:
+            with open(options["path"], "rb") as f:
+                sync = UserCountSync(read_user_counts(options["path"], f))
+            if options["dry_run"]:
+                sync.validate()
+                self.stdout.write("{} cost centres would be updated".format(len(sync.changes)))
+            else:
+                changed, unknown = sync.save()
+                self.stdout.write("Updated {} cost centres".format(changed))
+        except ValidationError as e:
+            raise CommandError("\n".join(e.messages))
+        if sync.unknown:
+            self.stderr.write("Skipped unknown cost centre codes: {}".format(", ".join(sync.unknown)))
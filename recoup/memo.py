@@ -0,0 +1,50 @@
+from contextlib import contextmanager
+from functools import wraps
+import threading
+
+_state = threading.local()
+
+
+@contextmanager
+def scope():
+    """
+    Memoize values within the block (e.g. one request, see MemoMiddleware)
+    Nested scopes share the outermost one; values are dropped when it exits
+    """
+    outer = getattr(_state, "values", None)
+    if outer is None:
+        _state.values = {}
+    try:
+        yield
+    finally:
+        if outer is None:
+            _state.values = None
+
+
+def clear():
+    values = getattr(_state, "values", None)
+    if values is not None:
+        values.clear()
+
+
+def get(key, compute):
+    """
+    The value for key in the current scope, computing it on first use
+    Outside a scope nothing is memoized
+    """
+    values = getattr(_state, "values", None)
+    if values is None:
+        return compute()
+    if key not in values:
+        values[key] = compute()
+    return values[key]
+
+
+def memoized(method):
+    """
+    Memoize a model method per instance pk in the current scope
+    """
+    @wraps(method)
+    def wrapper(self):
+        return get((type(self).__name__, method.__name__, self.pk), lambda: method(self))
+    return wrapper
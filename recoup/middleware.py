@@ -0,0 +1,64 @@
+from django.conf import settings
+from fnmatch import fnmatchcase
+import json
+import logging
+
+from recoup import memo
+from recoup.profiling import Profile
+
+LOGGER = logging.getLogger('recoup.profile')
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+class MemoMiddleware(object):
+    """
+    Scopes recoup.memo to each request, so values computed while rendering
+    a page are reused within it and never leak into the next request
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with memo.scope():
+            return self.get_response(request)
+
+
+def query_budget(view_name):
+    # QUERY_BUDGETS keys are URL names, or glob patterns matching them
+    budgets = getattr(settings, 'QUERY_BUDGETS', {})
+    if view_name in budgets:
+        return budgets[view_name]
+    for pattern, budget in budgets.items():
+        if fnmatchcase(view_name, pattern):
+            return budget
+    return None
+
+
+class ProfilingMiddleware(object):
+    """
+    Logs the query count, SQL time, Python time and slowest statements of
+    each request, and checks the query count against the URL's budget
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with Profile(slowest=getattr(settings, 'PROFILE_SLOWEST', 3)) as profile:
+            response = self.get_response(request)
+        match = getattr(request, 'resolver_match', None)
+        view_name = match.view_name if match else None
+        summary = profile.summary()
+        LOGGER.info(json.dumps(dict(
+            summary, method=request.method, path=request.path, view=view_name, status=response.status_code)))
+        if getattr(settings, 'PROFILE_HEADER', settings.DEBUG):
+            response['X-Scrooge-Profile'] = 'queries={queries}; sql_ms={sql_ms}; python_ms={python_ms}; total_ms={total_ms}'.format(**summary)
+        budget = query_budget(view_name) if view_name else None
+        if budget is not None and profile.queries > budget:
+            message = '{} ran {} queries, over its budget of {}'.format(view_name, profile.queries, budget)
+            if getattr(settings, 'QUERY_BUDGET_STRICT', False):
+                raise QueryBudgetExceeded(message)
+            LOGGER.warning(message)
+        return response
@@ -0,0 +1,79 @@
+# Generated by Django 2.0.8 on 2026-10-18 17:59
+
+from django.db import migrations, models
+from django.db.models import Q, Sum
+
+
+def populate_cost_totals(apps, schema_editor):
+    for model_name, relation, active_only in (
+            ("Contract", "bill", True), ("FinancialYear", "bill", True), ("ServicePool", "cost_items", False),
+            ("EndUserService", "endusercost", False), ("Platform", "itplatformcost", False)):
+        model = apps.get_model("recoup", model_name)
+        condition = Q(**{"{}__active".format(relation): True}) if active_only else None
+        queryset = model.objects.annotate(
+            cost_sum=Sum("{}__cost".format(relation), filter=condition),
+            cost_estimate_sum=Sum("{}__cost_estimate".format(relation), filter=condition))
+        for obj in queryset:
+            model.objects.filter(pk=obj.pk).update(
+                total_cost=obj.cost_sum or 0, total_cost_estimate=obj.cost_estimate_sum or 0)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recoup', '0011_auto_20180529_1236'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='contract',
+            name='total_cost',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=14),
+        ),
+        migrations.AddField(
+            model_name='contract',
+            name='total_cost_estimate',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=14),
+        ),
+        migrations.AddField(
+            model_name='enduserservice',
+            name='total_cost',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=14),
+        ),
+        migrations.AddField(
+            model_name='enduserservice',
+            name='total_cost_estimate',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=14),
+        ),
+        migrations.AddField(
+            model_name='financialyear',
+            name='total_cost',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=14),
+        ),
+        migrations.AddField(
+            model_name='financialyear',
+            name='total_cost_estimate',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=14),
+        ),
+        migrations.AddField(
+            model_name='platform',
+            name='total_cost',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=14),
+        ),
+        migrations.AddField(
+            model_name='platform',
+            name='total_cost_estimate',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=14),
+        ),
+        migrations.AddField(
+            model_name='servicepool',
+            name='total_cost',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=14),
+        ),
+        migrations.AddField(
+            model_name='servicepool',
+            name='total_cost_estimate',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=14),
+        ),
+        migrations.RunPython(populate_cost_totals, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 2.0.8 on 2026-10-18 19:41
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recoup', '0013_report_jobs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='financialyear',
+            name='is_current',
+            field=models.BooleanField(default=False, editable=False, help_text='The year costs are reported for unless another is chosen'),
+        ),
+        migrations.AddField(
+            model_name='cost',
+            name='year',
+            field=models.ForeignKey(editable=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='cost_items', to='recoup.FinancialYear'),
+        ),
+        migrations.AddField(
+            model_name='reportjob',
+            name='year',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='recoup.FinancialYear'),
+        ),
+    ]
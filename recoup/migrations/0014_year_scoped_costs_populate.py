@@ -0,0 +1,42 @@
+# Generated by Django 2.0.8 on 2026-10-18 19:41
+
+from django.db import migrations
+from django.db.models import OuterRef, Q, Subquery, Sum
+
+
+def populate_years(apps, schema_editor):
+    Bill = apps.get_model("recoup", "Bill")
+    Cost = apps.get_model("recoup", "Cost")
+    FinancialYear = apps.get_model("recoup", "FinancialYear")
+    Cost.objects.update(year=Subquery(Bill.objects.filter(pk=OuterRef("bill_id")).values("year_id")[:1]))
+    # The year reported on until now, which the stored totals become specific to
+    year = FinancialYear.objects.order_by("end").first()
+    if year is None:
+        return
+    FinancialYear.objects.filter(pk=year.pk).update(is_current=True)
+    for model_name, relation, active_only in (
+            ("Contract", "bill", True), ("ServicePool", "cost_items", False),
+            ("EndUserService", "endusercost", False), ("Platform", "itplatformcost", False)):
+        model = apps.get_model("recoup", model_name)
+        condition = Q(**{"{}__year".format(relation): year})
+        if active_only:
+            condition &= Q(**{"{}__active".format(relation): True})
+        queryset = model.objects.annotate(
+            cost_sum=Sum("{}__cost".format(relation), filter=condition),
+            cost_estimate_sum=Sum("{}__cost_estimate".format(relation), filter=condition))
+        for obj in queryset:
+            model.objects.filter(pk=obj.pk).update(
+                total_cost=obj.cost_sum or 0, total_cost_estimate=obj.cost_estimate_sum or 0)
+
+
+class Migration(migrations.Migration):
+    # Apart from the schema changes either side of it, as PostgreSQL can't alter
+    # a table with pending deferred foreign key checks in the same transaction
+
+    dependencies = [
+        ('recoup', '0014_year_scoped_costs'),
+    ]
+
+    operations = [
+        migrations.RunPython(populate_years, migrations.RunPython.noop),
+    ]
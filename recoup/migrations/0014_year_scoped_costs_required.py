@@ -0,0 +1,23 @@
+# Generated by Django 2.0.8 on 2026-10-18 19:41
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recoup', '0014_year_scoped_costs_populate'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='cost',
+            name='year',
+            field=models.ForeignKey(editable=False, on_delete=django.db.models.deletion.PROTECT, related_name='cost_items', to='recoup.FinancialYear'),
+        ),
+        migrations.AddIndex(
+            model_name='bill',
+            index=models.Index(fields=['year', 'active'], name='recoup_bill_year_id_1ac9fa_idx'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 2.0.8 on 2026-10-18 18:18
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recoup', '0014_year_scoped_costs_required'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='financialyear',
+            name='closed',
+            field=models.DateTimeField(blank=True, editable=False, help_text="When the year's costs were frozen, see CostSnapshot", null=True),
+        ),
+        migrations.CreateModel(
+            name='CostSnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.CharField(max_length=32)),
+                ('object_id', models.PositiveIntegerField()),
+                ('cost', models.DecimalField(decimal_places=2, max_digits=14)),
+                ('cost_estimate', models.DecimalField(decimal_places=2, max_digits=14)),
+                ('values', models.TextField(default='{}')),
+                ('year', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='snapshots', to='recoup.FinancialYear')),
+            ],
+            options={
+                'unique_together': {('year', 'model', 'object_id')},
+            },
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 2.0.8 on 2026-10-18 18:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recoup', '0015_cost_snapshots'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DirtyNode',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.PositiveIntegerField(db_index=True)),
+                ('model', models.CharField(blank=True, max_length=32)),
+                ('object_id', models.PositiveIntegerField(null=True)),
+            ],
+        ),
+    ]
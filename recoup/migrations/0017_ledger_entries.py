@@ -0,0 +1,36 @@
+# Generated by Django 2.0.8 on 2026-10-18 19:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recoup', '0016_dirty_nodes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LedgerEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('vendor', models.CharField(db_index=True, max_length=320)),
+                ('cost', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('cost_estimate', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('bill', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='recoup.Bill')),
+                ('contract', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='recoup.Contract')),
+                ('cost_centre', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='recoup.CostCentre')),
+                ('division', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='recoup.Division')),
+                ('platform', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='recoup.Platform')),
+                ('service', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='recoup.EndUserService')),
+                ('service_pool', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='recoup.ServicePool')),
+                ('split', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ledger_entries', to='recoup.Cost')),
+                ('system', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='recoup.ITSystem')),
+                ('year', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ledger_entries', to='recoup.FinancialYear')),
+            ],
+            options={
+                'verbose_name_plural': 'ledger entries',
+            },
+        ),
+    ]
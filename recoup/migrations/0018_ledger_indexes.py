@@ -0,0 +1,25 @@
+# Generated by Django 2.0.8 on 2026-10-18 19:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recoup', '0017_ledger_entries'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='ledgerentry',
+            index=models.Index(fields=['system', 'year'], name='recoup_ledg_system__344a99_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='ledgerentry',
+            index=models.Index(fields=['cost_centre', 'year'], name='recoup_ledg_cost_ce_22c775_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='ledgerentry',
+            index=models.Index(fields=['division', 'year'], name='recoup_ledg_divisio_ec21c1_idx'),
+        ),
+    ]
@@ -0,0 +1,64 @@
+# Generated by Django 2.0.8 on 2026-10-18 21:12
+
+from collections import defaultdict
+from django.db import migrations
+
+from recoup import kernel
+from recoup.graph import Table
+from recoup.ledger import shares
+
+
+def populate_ledger(apps, schema_editor):
+    # As recoup.ledger.rebuild() fills the ledger of every open year, with the models as of this migration
+    def model(name):
+        return apps.get_model("recoup", name)
+    LedgerEntry = model("LedgerEntry")
+    systems = {
+        pk: (cost_centre, division)
+        for pk, cost_centre, division in model("ITSystem").objects.values_list("pk", "cost_centre_id", "division_id")}
+    dependencies = defaultdict(list)
+    for system, platform, weighting in model("SystemDependency").objects.values_list(
+            "system_id", "platform_id", "weighting"):
+        dependencies[platform].append((system, weighting))
+    user_counts = dict(model("Division").objects.values_list("pk", "user_count"))
+    members = defaultdict(list)
+    for service, division in model("EndUserService").divisions.through.objects.values_list(
+            "enduserservice_id", "division_id"):
+        members[service].append((division, user_counts[division]))
+    for year in model("FinancialYear").objects.filter(closed__isnull=True):
+        bills = {
+            pk: (contract, vendor)
+            for pk, contract, vendor in model("Bill").objects.filter(year=year).values_list(
+                "pk", "contract_id", "contract__vendor")}
+        rows = []
+        for split_model, field, recipients in (
+                ("ITPlatformCost", "platform_id", dependencies), ("EndUserCost", "service_id", members)):
+            costs = Table.load(
+                model(split_model).objects.filter(year=year).order_by(field, "pk"), "pk", "bill_id",
+                "service_pool_id", field, "cost", "cost_estimate")
+            values = list(costs.rows("pk", "bill_id", "service_pool_id", field))
+            for row, key, cost, estimate in shares(costs, field, recipients):
+                split, bill, service_pool, target = values[row]
+                entry = LedgerEntry(
+                    year=year, split_id=split, bill_id=bill, contract_id=bills[bill][0], vendor=bills[bill][1],
+                    service_pool_id=service_pool, cost=kernel.amounts([cost])[0],
+                    cost_estimate=kernel.amounts([estimate])[0], **{field: target})
+                if key is not None and field == "platform_id":
+                    entry.system_id = key
+                    entry.cost_centre_id, entry.division_id = systems[key]
+                elif key is not None:
+                    entry.division_id = key
+                rows.append(entry)
+        LedgerEntry.objects.filter(year=year).delete()
+        LedgerEntry.objects.bulk_create(rows)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recoup', '0018_ledger_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(populate_ledger, migrations.RunPython.noop),
+    ]
@@ -1,16 +1,51 @@
-from datetime import date
+from datetime import date, timedelta
 from decimal import Decimal
-from django.db import models
+from functools import wraps
+import os
+from django.conf import settings
+from django.db import connection, models, transaction
+from django.core.exceptions import ValidationError
 from django.core.validators import MinValueValidator, MaxValueValidator
-from django.db.models.signals import post_save, pre_save
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
 from django.dispatch import receiver
+from django.utils import timezone
 from django.utils.html import format_html
 
+from recoup import kernel, memo, propagation
+from recoup.memo import memoized
+
+
+def next_year(day):
+    # The same day a year later, 29 February becoming the 28th
+    try:
+        return day.replace(year=day.year + 1)
+    except ValueError:
+        return day.replace(year=day.year + 1, day=28)
+
 
 def field_sum(queryset, fieldname):
     return queryset.aggregate(models.Sum(fieldname))["{}__sum".format(fieldname)]
 
 
+def precomputed(method):
+    """
+    Return a value already stored on the instance as _<method name> (e.g. by
+    Allocation.apply or queries.with_costs) instead of querying for it again
+    Calls given arguments (e.g. another financial year) always query
+    The admin sorts by the annotation of the same name
+    """
+    attr = "_{}".format(method.__name__)
+
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        defaults = all(arg is None for arg in args) and all(arg is None for arg in kwargs.values())
+        if defaults and attr in self.__dict__:
+            return self.__dict__[attr]
+        return method(self, *args, **kwargs)
+    wrapper.admin_order_field = attr
+    return wrapper
+
+
 class CostSummary(models.Model):
     """
     Maintains some fields for summarising costs for an object
@@ -18,44 +53,87 @@ class CostSummary(models.Model):
     def __str__(self):
         return self.name
 
-    def get_cost_queryset(self):
+    def get_cost_queryset(self, year):
         """
-        Override with appropriate filtering across bills or costs
+        Override with appropriate filtering across the bills or costs of a year
         """
         return self.__class__.objects.none()
 
-    def cost(self):
-        return field_sum(self.get_cost_queryset(), "cost") or Decimal(0)
+    @precomputed
+    def cost(self, year=None):
+        return field_sum(self.get_cost_queryset(year or self.year), "cost") or Decimal(0)
 
-    def cost_estimate(self):
-        return field_sum(self.get_cost_queryset(), "cost_estimate") or Decimal(0)
+    @precomputed
+    def cost_estimate(self, year=None):
+        return field_sum(self.get_cost_queryset(year or self.year), "cost_estimate") or Decimal(0)
 
     @property
     def year(self):
-        return FinancialYear.objects.first()
+        """
+        The financial year costs are for unless another is given
+        """
+        return FinancialYear.current()
+
+    @precomputed
+    def year_cost(self, year=None):
+        return (year or self.year).cost()
+
+    @precomputed
+    def year_cost_estimate(self, year=None):
+        return (year or self.year).cost_estimate()
 
-    def cost_percentage(self):
-        year_cost = self.year.cost()
+    @precomputed
+    def cost_percentage(self, year=None):
+        year_cost = self.year_cost(year)
         if year_cost == Decimal(0):
             return 0
-        return round(self.cost() / year_cost * 100, 2)
+        return round(self.cost(year) / year_cost * 100, 2)
 
     cost_percentage.short_description = "Cost/FY %"
+    cost_percentage.admin_order_field = "_cost"
 
-    def cost_estimate_percentage(self):
-        year_cost_est = self.year.cost_estimate()
+    @precomputed
+    def cost_estimate_percentage(self, year=None):
+        year_cost_est = self.year_cost_estimate(year)
         if year_cost_est == Decimal(0):
             return 0
-        return round(self.cost_estimate() / year_cost_est * 100, 2)
+        return round(self.cost_estimate(year) / year_cost_est * 100, 2)
 
     cost_estimate_percentage.short_description = "Estimate/FY %"
+    cost_estimate_percentage.admin_order_field = "_cost_estimate"
 
     class Meta:
         abstract = True
         ordering = ('name',)
 
 
-class Contract(CostSummary):
+class CostTotal(CostSummary):
+    """
+    A CostSummary that stores its totals for the current financial year rather
+    than aggregating them on read. Bills and costs adjust the totals by deltas
+    as they change (see cost_totals) and rebuild_cost_totals recalculates them
+    from scratch. Other years are aggregated
+    """
+    total_cost = models.DecimalField(max_digits=14, decimal_places=2, default=0, editable=False)
+    total_cost_estimate = models.DecimalField(max_digits=14, decimal_places=2, default=0, editable=False)
+
+    @precomputed
+    def cost(self, year=None):
+        if year is None or year == self.year:
+            return self.total_cost
+        return super(CostTotal, self).cost(year)
+
+    @precomputed
+    def cost_estimate(self, year=None):
+        if year is None or year == self.year:
+            return self.total_cost_estimate
+        return super(CostTotal, self).cost_estimate(year)
+
+    class Meta(CostSummary.Meta):
+        abstract = True
+
+
+class Contract(CostTotal):
     vendor = models.CharField(max_length=320)
     brand = models.CharField(max_length=320, default="N/A")
     reference = models.CharField(max_length=320, default="N/A")
@@ -64,8 +142,8 @@ class Contract(CostSummary):
     end = models.DateField(null=True, blank=True)
     active = models.BooleanField(default=True)
 
-    def get_cost_queryset(self):
-        return self.bill_set.filter(active=True)
+    def get_cost_queryset(self, year):
+        return self.bill_set.filter(active=True, year=year)
 
     def __str__(self):
         return "{} ({})".format(self.vendor, self.reference)
@@ -74,17 +152,102 @@ class Contract(CostSummary):
         ordering = ('vendor',)
 
 
-class FinancialYear(CostSummary):
+class FinancialYear(CostTotal):
     """
     Maintains a running total for the full cost of a year
     Totals are used to calculate percentage values of costs for invoicing
     """
     start = models.DateField()
     end = models.DateField()
+    is_current = models.BooleanField(
+        default=False, editable=False, help_text="The year costs are reported for unless another is chosen")
+    closed = models.DateTimeField(
+        null=True, blank=True, editable=False, help_text="When the year's costs were frozen, see CostSnapshot")
 
-    def get_cost_queryset(self):
+    @classmethod
+    def current(cls):
+        """
+        The current financial year, which CostTotal rows store their totals for
+        Without one marked current it is the earliest
+        """
+        return memo.get("financial_year", lambda: cls.objects.filter(is_current=True).first() or cls.objects.first())
+
+    def get_cost_queryset(self, year=None):
         return self.bill_set.filter(active=True)
 
+    # A year's own totals are only ever for itself
+    @precomputed
+    def cost(self, year=None):
+        return self.total_cost
+
+    @precomputed
+    def cost_estimate(self, year=None):
+        return self.total_cost_estimate
+
+    @transaction.atomic
+    def make_current(self):
+        """
+        Report on this year by default, rebuilding the stored totals for it
+        """
+        from recoup.allocation import rebuild_cost_totals
+        FinancialYear.objects.exclude(pk=self.pk).update(is_current=False)
+        FinancialYear.objects.filter(pk=self.pk).update(is_current=True)
+        self.is_current = True
+        cost_data_changed()
+        rebuild_cost_totals()
+
+    @transaction.atomic
+    def close(self):
+        """
+        Freeze the year's computed costs in CostSnapshot rows, which reports on
+        the year then read instead of the live data. Its bills can't be changed
+        """
+        from recoup.allocation import Allocation
+        if self.closed:
+            raise ValidationError("{} is already closed".format(self))
+        CostSnapshot.objects.bulk_create(Allocation.load(self).snapshot(self))
+        self.closed = timezone.now()
+        FinancialYear.objects.filter(pk=self.pk).update(closed=self.closed)
+        cost_data_changed()
+
+    @transaction.atomic
+    def reopen(self):
+        CostSnapshot.objects.filter(year=self).delete()
+        self.closed = None
+        FinancialYear.objects.filter(pk=self.pk).update(closed=None)
+        cost_data_changed()
+
+    @transaction.atomic
+    def rollover(self, uplift=Decimal(0)):
+        """
+        Create the following financial year with a copy of each of this year's
+        active bills and their cost splits, the cost estimates raised by uplift
+        percent. Rows are bulk inserted and totals moved once at the end
+        """
+        start, end = next_year(self.start), next_year(self.end)
+        if FinancialYear.objects.filter(start=start).exists():
+            raise ValidationError("The {}/{} financial year already exists".format(start.year, end.year))
+        year = FinancialYear.objects.create(start=start, end=end)
+        bills = list(self.bill_set.filter(active=True))
+        copies = [Bill(
+            contract_id=bill.contract_id, name=bill.name, description=bill.description, comment=bill.comment,
+            quantity=bill.quantity, year=year, renewal_date=bill.renewal_date and next_year(bill.renewal_date),
+            cost=bill.cost, cost_estimate=round(bill.cost_estimate * (1 + Decimal(uplift) / 100), 2))
+            for bill in bills]
+        bulk_insert(Bill, copies)
+        copied = {bill.pk: copy for bill, copy in zip(bills, copies)}
+        costs = []
+        for model in (EndUserCost, ITPlatformCost):
+            for cost in model.objects.filter(bill__in=list(copied)):
+                cost.pk = cost.id = None
+                cost.bill, cost.cost, cost.cost_estimate = copied[cost.bill_id], 0, 0
+                costs.append(cost)
+        bulk_create_costs(costs)
+        recompute_costs(copies)
+        update_cost_totals([], [total for bill in copies for total in bill.cost_totals()])
+        cost_data_changed()
+        return year
+
     def __str__(self):
         return "{}/{}".format(self.start.year, self.end.year)
 
@@ -107,29 +270,51 @@ class Bill(models.Model):
     cost_estimate = models.DecimalField(max_digits=12, decimal_places=2, default=0)
     active = models.BooleanField(default=True)
 
+    def clean(self):
+        if self.year_id and self.year.closed:
+            raise ValidationError("The {} financial year is closed".format(self.year))
+
+    @precomputed
     def allocated(self):
         return field_sum(self.cost_items.all(), "percentage") or 0
 
+    def cost_totals(self):
+        if not self.active:
+            return []
+        totals = [(FinancialYear, self.year_id, self.cost, self.cost_estimate)]
+        if self.year_id == FinancialYear.current().pk:
+            totals.append((Contract, self.contract_id, self.cost, self.cost_estimate))
+        return totals
+
     def post_save(self):
         # recalculate child cost values
-        for cost in EndUserCost.objects.filter(bill=self):
-            cost.save()
-        for cost in ITPlatformCost.objects.filter(bill=self):
-            cost.save()
+        propagation.schedule(recompute_bill_costs, [self.pk])
+
+    def linked_nodes(self):
+        # Saving a bill changes its cost splits without their hooks running
+        nodes = set()
+        for pool, service, platform in self.cost_items.values_list(
+                "service_pool_id", "endusercost__service_id", "itplatformcost__platform_id"):
+            nodes.update(((ServicePool, pool), (EndUserService, service), (Platform, platform)))
+        return {(model, pk) for model, pk in nodes if pk is not None}
 
     def __str__(self):
         return self.name
 
     class Meta:
         ordering = ("-cost_estimate",)
+        indexes = [models.Index(fields=["year", "active"])]
 
 
-class ServicePool(CostSummary):
+class ServicePool(CostTotal):
     """
     ServicePool used for reporting
     """
     name = models.CharField(max_length=320, editable=False, unique=True)
 
+    def get_cost_queryset(self, year):
+        return self.cost_items.filter(year=year)
+
 
 class Cost(CostSummary):
     name = models.CharField(max_length=320)
@@ -140,12 +325,51 @@ class Cost(CostSummary):
     service_pool = models.ForeignKey(ServicePool, related_name="cost_items", on_delete=models.PROTECT)
     cost = models.DecimalField(max_digits=12, decimal_places=2, default=0, editable=False)
     cost_estimate = models.DecimalField(max_digits=12, decimal_places=2, default=0, editable=False)
+    # The bill's year, so costs can be filtered by year without joining bills
+    year = models.ForeignKey(FinancialYear, related_name="cost_items", editable=False, on_delete=models.PROTECT)
+
+    @staticmethod
+    def split(bills, costs):
+        """
+        The (cost, cost_estimate) of each of a list of cost splits of bills
+        ({pk: bill}), as stored. The percentage of each bill allocated is shared
+        between its splits to the cent (see kernel.apportion), so the splits of
+        a fully allocated bill add up to it exactly
+        """
+        index = {pk: i for i, pk in enumerate(bills)}
+        allocated = [Decimal(0)] * len(bills)
+        for cost in costs:
+            allocated[index[cost.bill_id]] += cost.percentage
+        # Ties go to the oldest split
+        keys = [cost.pk for cost in costs]
+        values = []
+        for field in ("cost", "cost_estimate"):
+            totals = kernel.cents(
+                round(Decimal(getattr(bill, field)) * percentage / Decimal(100), 2) if bill.active else 0
+                for bill, percentage in zip(bills.values(), allocated))
+            values.append(kernel.amounts(kernel.apportion(
+                totals, [index[cost.bill_id] for cost in costs], [cost.percentage for cost in costs], keys)))
+        return list(zip(*values))
+
+    def in_current_year(self):
+        return self.year_id == FinancialYear.current().pk
+
+    def clean(self):
+        if self.bill_id and self.bill.year.closed:
+            raise ValidationError("The {} financial year is closed".format(self.bill.year))
 
     def pre_save(self):
-        if not self.bill.active:
-            self.cost, self.cost_estimate = 0, 0
-        self.cost = self.bill.cost * self.percentage / Decimal(100)
-        self.cost_estimate = self.bill.cost_estimate * self.percentage / Decimal(100)
+        self.year_id = self.bill.year_id
+
+    def post_save(self):
+        # Derived with the other splits of the bill, whose shares may move by a cent
+        propagation.schedule(recompute_bill_costs, [self.bill_id])
+
+    def post_delete(self):
+        propagation.schedule(recompute_bill_costs, [self.bill_id])
+
+    def linked_nodes(self):
+        return self.bill.linked_nodes()
 
     class Meta:
         ordering = ("-percentage",)
@@ -159,35 +383,58 @@ class Division(CostSummary):
     user_count = models.PositiveIntegerField(default=0)
     position = models.PositiveIntegerField(unique=True)
 
+    @precomputed
     def cc_count(self):
         return self.costcentre_set.count()
 
+    @precomputed
     def system_count(self):
         return self.systems_by_cc().count()
 
-    def enduser_cost(self):
-        total = Decimal(0)
-        for service in self.enduserservice_set.all():
-            total += round(Decimal(self.user_count) / Decimal(service.total_user_count()) * service.cost(), 2)
-        return total
+    def service_share(self, service, amount):
+        """
+        The division's part of an amount shared by user count between the
+        divisions using an end user service, to the cent (see kernel.apportion).
+        Reads service.divisions as prefetched by services()
+        """
+        divisions = sorted((division.pk, division.user_count) for division in service.divisions.all())
+        return kernel.share(amount, [count for pk, count in divisions], [pk for pk, count in divisions].index(self.pk))
+
+    def services(self):
+        """
+        The end user services the division uses, with their divisions prefetched for service_share
+        """
+        models.prefetch_related_objects([self], "enduserservice_set__divisions")
+        return self.enduserservice_set.all()
+
+    @precomputed
+    def enduser_cost(self, year=None):
+        return sum((self.service_share(service, service.cost(year)) for service in self.services()), Decimal(0))
+
+    @precomputed
+    def enduser_estimate(self, year=None):
+        return sum(
+            (self.service_share(service, service.cost_estimate(year)) for service in self.services()), Decimal(0))
 
-    def enduser_estimate(self):
-        total = Decimal(0)
-        for service in self.enduserservice_set.all():
-            total += round(Decimal(self.user_count) / Decimal(service.total_user_count()) * service.cost_estimate(), 2)
-        return total
+    @precomputed
+    def system_cost(self, year=None):
+        return sum(system.cost(year) for system in ITSystem.with_dependencies(self.systems_by_cc()))
 
-    def system_cost(self):
-        return sum(system.cost() for system in self.systems_by_cc().all())
+    @precomputed
+    def system_cost_estimate(self, year=None):
+        return sum(system.cost_estimate(year) for system in ITSystem.with_dependencies(self.systems_by_cc()))
 
-    def system_cost_estimate(self):
-        return sum(system.cost_estimate() for system in self.systems_by_cc().all())
+    @precomputed
+    def cost(self, year=None):
+        return self.enduser_cost(year) + self.system_cost(year)
 
-    def cost(self):
-        return self.enduser_cost() + self.system_cost()
+    @precomputed
+    def cost_estimate(self, year=None):
+        return self.enduser_estimate(year) + self.system_cost_estimate(year)
 
-    def cost_estimate(self):
-        return self.enduser_estimate() + self.system_cost_estimate()
+    @staticmethod
+    def total_user_count():
+        return memo.get("division_user_count", lambda: field_sum(Division.objects.all(), "user_count"))
 
     def systems_by_cc(self):
         return self.itsystem_set.filter(systemdependency__isnull=False).order_by("cost_centre", "name").distinct()
@@ -195,8 +442,9 @@ class Division(CostSummary):
     def bill(self):
         return format_html('<a href="/bill?division={}" target="_blank">Bill</a>', self.pk)
 
+    @precomputed
     def user_count_percentage(self):
-        return round(self.user_count / field_sum(Division.objects.all(), 'user_count') * 100, 2)
+        return round(self.user_count / Division.total_user_count() * 100, 2)
 
     class Meta:
         ordering = ('position',)
@@ -211,22 +459,24 @@ class CostCentre(models.Model):
     def systems(self):
         return self.itsystem_set.filter(systemdependency__isnull=False).distinct()
 
+    @precomputed
     def system_count(self):
         return self.systems().count()
 
-    def system_cost(self):
-        return sum(system.cost() for system in self.systems())
+    @precomputed
+    def system_cost(self, year=None):
+        return sum(system.cost(year) for system in ITSystem.with_dependencies(self.systems()))
 
-    def system_cost_estimate(self):
-        return sum(system.cost_estimate() for system in self.systems())
+    @precomputed
+    def system_cost_estimate(self, year=None):
+        return sum(system.cost_estimate(year) for system in ITSystem.with_dependencies(self.systems()))
 
+    @precomputed
     def user_count_percentage(self):
-        return round(self.user_count / field_sum(Division.objects.all(), 'user_count') * 100, 2)
+        return round(self.user_count / Division.total_user_count() * 100, 2)
 
     def post_save(self):
-        self.division.user_count = field_sum(self.division.costcentre_set.all(), "user_count")
-        if self.division.user_count > 0:
-            self.division.save()
+        propagation.schedule(update_division_user_counts, [self.division_id])
 
     def __str__(self):
         return self.code
@@ -235,18 +485,20 @@ class CostCentre(models.Model):
         ordering = ('name',)
 
 
-class EndUserService(CostSummary):
+class EndUserService(CostTotal):
     """
     Grouping used to simplify linkages of costs to divisions, and for reporting
     """
     name = models.CharField(max_length=320)
     divisions = models.ManyToManyField(Division)
 
+    @precomputed
+    @memoized
     def total_user_count(self):
         return field_sum(self.divisions, "user_count")
 
-    def get_cost_queryset(self):
-        return self.endusercost_set.filter()
+    def get_cost_queryset(self, year):
+        return self.endusercost_set.filter(year=year)
 
 
 class EndUserCost(Cost):
@@ -255,8 +507,15 @@ class EndUserCost(Cost):
     """
     service = models.ForeignKey(EndUserService, on_delete=models.PROTECT)
 
+    def cost_totals(self):
+        if not self.in_current_year():
+            return []
+        return [
+            (ServicePool, self.service_pool_id, self.cost, self.cost_estimate),
+            (EndUserService, self.service_id, self.cost, self.cost_estimate)]
 
-class Platform(CostSummary):
+
+class Platform(CostTotal):
     """
     Platform or Infrastructure IT systems depend on
     Grouping used to simplify linkages of costs to systems, and for reporting
@@ -264,14 +523,17 @@ class Platform(CostSummary):
     """
     name = models.CharField(max_length=320)
 
+    @precomputed
     def system_count(self):
         return self.systemdependency_set.count()
 
+    @precomputed
+    @memoized
     def system_weight_total(self):
         return field_sum(self.systemdependency_set, "weighting")
 
-    def get_cost_queryset(self):
-        return self.itplatformcost_set.all()
+    def get_cost_queryset(self, year):
+        return self.itplatformcost_set.filter(year=year)
 
     class Meta(CostSummary.Meta):
         abstract = False
@@ -288,17 +550,40 @@ class ITSystem(CostSummary):
     division = models.ForeignKey(Division, on_delete=models.PROTECT)
     depends_on = models.ManyToManyField(Platform, through="SystemDependency")
 
-    def cost(self):
-        total = Decimal(0)
-        for dep in self.systemdependency_set.all():
-            total += dep.platform.cost() * Decimal(dep.weighting / dep.platform.system_weight_total())
-        return round(total, 2)
+    def platform_share(self, platform, amount):
+        """
+        The system's part of an amount shared by weighting between the systems
+        depending on a platform, to the cent (see kernel.apportion). Reads the
+        platform's dependencies as prefetched by with_dependencies
+        """
+        systems = sorted((dep.system_id, dep.weighting) for dep in platform.systemdependency_set.all())
+        return kernel.share(amount, [weighting for pk, weighting in systems], [pk for pk, w in systems].index(self.pk))
 
-    def cost_estimate(self):
-        total = Decimal(0)
-        for dep in self.systemdependency_set.all():
-            total += dep.platform.cost_estimate() * Decimal(dep.weighting / dep.platform.system_weight_total())
-        return round(total, 2)
+    @staticmethod
+    def with_dependencies(systems):
+        """
+        The systems with their dependencies, those dependencies' platforms and
+        every system's dependency on each platform prefetched, so cost and
+        platform_share read them without a query per system. Lookups already
+        prefetched are kept
+        """
+        systems = list(systems)
+        models.prefetch_related_objects(systems, "systemdependency_set__platform__systemdependency_set")
+        return systems
+
+    @precomputed
+    def cost(self, year=None):
+        self.with_dependencies([self])
+        return sum(
+            (self.platform_share(dep.platform, dep.platform.cost(year)) for dep in self.systemdependency_set.all()),
+            Decimal(0))
+
+    @precomputed
+    def cost_estimate(self, year=None):
+        self.with_dependencies([self])
+        return sum((
+            self.platform_share(dep.platform, dep.platform.cost_estimate(year))
+            for dep in self.systemdependency_set.all()), Decimal(0))
 
     def depends_on_display(self):
         return ", ".join(str(p) for p in self.depends_on.all())
@@ -321,10 +606,6 @@ class SystemDependency(CostSummary):
     platform = models.ForeignKey(Platform, on_delete=models.PROTECT)
     weighting = models.FloatField(default=1)
 
-    def post_save(self):
-        self.platform.system_count = self.platform.systemdependency_set.count()
-        self.platform.save()
-
     def __str__(self):
         return "{} depends on {}".format(self.system, self.platform)
 
@@ -338,13 +619,327 @@ class ITPlatformCost(Cost):
     """
     platform = models.ForeignKey(Platform, on_delete=models.PROTECT)
 
+    def cost_totals(self):
+        if not self.in_current_year():
+            return []
+        return [
+            (ServicePool, self.service_pool_id, self.cost, self.cost_estimate),
+            (Platform, self.platform_id, self.cost, self.cost_estimate)]
+
+
+class CostSnapshot(models.Model):
+    """
+    The computed costs of one node of the allocation graph (e.g. a division)
+    in a closed financial year. values holds the node's other computed values
+    as JSON, see Allocation.snapshot
+    """
+    year = models.ForeignKey(FinancialYear, related_name="snapshots", on_delete=models.CASCADE)
+    model = models.CharField(max_length=32)
+    object_id = models.PositiveIntegerField()
+    cost = models.DecimalField(max_digits=14, decimal_places=2)
+    cost_estimate = models.DecimalField(max_digits=14, decimal_places=2)
+    values = models.TextField(default="{}")
+
+    def __str__(self):
+        return "{} {} #{}".format(self.year, self.model, self.object_id)
+
+    class Meta:
+        unique_together = ("year", "model", "object_id")
+
+
+class LedgerEntry(models.Model):
+    """
+    One recipient's share of a cost split in an open financial year: a system
+    (and its cost centre and division) for platform costs, a division for end
+    user costs, or none for cost no recipient takes (e.g. a platform without
+    systems). Kept up to date by recoup.ledger as the cost data changes, so
+    allocated costs can be totalled by any of the fields in one query
+    """
+    year = models.ForeignKey(FinancialYear, related_name="ledger_entries", on_delete=models.CASCADE)
+    split = models.ForeignKey(Cost, related_name="ledger_entries", on_delete=models.CASCADE)
+    bill = models.ForeignKey(Bill, on_delete=models.CASCADE)
+    contract = models.ForeignKey(Contract, on_delete=models.CASCADE)
+    vendor = models.CharField(max_length=320, db_index=True)
+    service_pool = models.ForeignKey(ServicePool, on_delete=models.CASCADE)
+    platform = models.ForeignKey(Platform, null=True, on_delete=models.CASCADE)
+    service = models.ForeignKey(EndUserService, null=True, on_delete=models.CASCADE)
+    system = models.ForeignKey(ITSystem, null=True, on_delete=models.CASCADE)
+    cost_centre = models.ForeignKey(CostCentre, null=True, on_delete=models.CASCADE)
+    division = models.ForeignKey(Division, null=True, on_delete=models.CASCADE)
+    cost = models.DecimalField(max_digits=12, decimal_places=2)
+    cost_estimate = models.DecimalField(max_digits=12, decimal_places=2)
+
+    def __str__(self):
+        return "{} to {}".format(self.split, self.system or self.division or "no one")
+
+    class Meta:
+        verbose_name_plural = "ledger entries"
+        # For the per recipient sums of recoup.queries.allocated
+        indexes = [
+            models.Index(fields=["system", "year"]), models.Index(fields=["cost_centre", "year"]),
+            models.Index(fields=["division", "year"])]
+
+
+class DataVersion(models.Model):
+    """
+    Single row counter moved forward by every write to the cost data
+    Anything derived from the data (e.g. report files) is keyed by its version
+    """
+    version = models.PositiveIntegerField(default=0)
+    modified = models.DateTimeField(default=timezone.now)
+
+    @classmethod
+    def current(cls):
+        return cls.objects.values_list("version", flat=True).first() or 0
+
+    @classmethod
+    def bump(cls):
+        if not cls.objects.update(version=models.F("version") + 1, modified=timezone.now()):
+            cls.objects.create(version=1)
+        return cls.current()
+
+
+class DirtyNode(models.Model):
+    """
+    A node of the allocation graph changed by the write that moved DataVersion
+    to version, or without an object any node. See Allocation.refresh
+    """
+    # DataVersions of changes kept for refreshing shared allocations
+    HISTORY = 1000
+    version = models.PositiveIntegerField(db_index=True)
+    model = models.CharField(max_length=32, blank=True)
+    object_id = models.PositiveIntegerField(null=True)
+
+
+class ReportJob(models.Model):
+    """
+    A report queued for generation in the background by process_report_jobs
+    Finished reports are kept on disk under REPORT_ROOT, keyed by the
+    financial year they cover and the data version they were built from
+    """
+    QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+    STATUS_CHOICES = ((QUEUED, "Queued"), (RUNNING, "Running"), (DONE, "Done"), (FAILED, "Failed"))
+
+    report = models.CharField(max_length=64)
+    year = models.ForeignKey(FinancialYear, null=True, on_delete=models.CASCADE)
+    version = models.PositiveIntegerField()
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=QUEUED)
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+    error = models.TextField(blank=True, default="")
+
+    @staticmethod
+    def artifact_path(report, year_id, version):
+        return os.path.join(settings.REPORT_ROOT, "{}-{}-{}.xlsx".format(report, year_id, version))
+
+    @property
+    def path(self):
+        return self.artifact_path(self.report, self.year_id, self.version)
+
+    @classmethod
+    def enqueue(cls, report, year, version):
+        """
+        Return the live job for a report on a year at a data version, queueing one if needed
+        """
+        job = cls.objects.filter(report=report, year=year, version=version).exclude(status=cls.FAILED).first()
+        return job or cls.objects.create(report=report, year=year, version=version)
+
+    @classmethod
+    def requeue_stale(cls):
+        """
+        Queue again the jobs running for longer than REPORT_JOB_TIMEOUT, whose worker died building them
+        """
+        started = timezone.now() - timedelta(seconds=settings.REPORT_JOB_TIMEOUT)
+        return cls.objects.filter(status=cls.RUNNING, started__lt=started).update(status=cls.QUEUED, started=None)
+
+    def __str__(self):
+        return "{} {} v{} ({})".format(self.report, self.year, self.version, self.status)
+
+    class Meta:
+        ordering = ("created",)
+
+
+def is_cost_data(model):
+    return issubclass(model, (CostSummary, Bill, CostCentre))
+
+
+# Models with a node in the allocation graph, see recoup.allocation
+GRAPH_MODELS = (Contract, FinancialYear, ServicePool, EndUserService, Platform, ITSystem, CostCentre, Division)
+
+
+def graph_nodes(instance):
+    """
+    The allocation graph nodes (model, pk) a row of cost data is, or links to
+    """
+    nodes = {(type(instance), instance.pk)} if isinstance(instance, GRAPH_MODELS) else set()
+    for field in instance._meta.concrete_fields:
+        if field.is_relation and field.related_model in GRAPH_MODELS:
+            nodes.add((field.related_model, getattr(instance, field.attname)))
+    return {(model, pk) for model, pk in nodes if pk is not None}
+
+
+def cost_data_changed(nodes=None):
+    """
+    Call after every write to the cost data, with the allocation graph nodes
+    it changed if they are known. Changes are recorded once per transaction,
+    after every other recompute it scheduled (see recoup.propagation)
+    """
+    memo.clear()
+    nodes = [None] if nodes is None else nodes
+    propagation.schedule(record_changes, nodes, last=True)
+    propagation.schedule(update_ledger, nodes, last=True)
+
+
+def record_changes(nodes):
+    version = DataVersion.bump()
+    DirtyNode.objects.bulk_create([DirtyNode(version=version)] if None in nodes else [
+        DirtyNode(version=version, model=model._meta.model_name, object_id=pk) for model, pk in nodes])
+    # Once every HISTORY versions, whether or not allocations are shared
+    if version % DirtyNode.HISTORY == 0:
+        DirtyNode.objects.filter(version__lte=version - DirtyNode.HISTORY).delete()
+    memo.clear()
+
+
+def update_ledger(nodes):
+    from recoup import ledger
+    ledger.update(nodes)
+
+
+def recompute_bill_costs(pks):
+    recompute_costs(Bill.objects.filter(pk__in=pks))
+
+
+def update_division_user_counts(pks):
+    """
+    Set divisions' user counts to the sum of their cost centres', summed in
+    one grouped query and written in one UPDATE
+    """
+    totals = CostCentre.objects.filter(division__in=pks).order_by().values_list("division").annotate(
+        models.Sum("user_count"))
+    current = dict(Division.objects.filter(pk__in=pks).values_list("pk", "user_count"))
+    changed = {pk: {"user_count": total} for pk, total in totals if total > 0 and current[pk] != total}
+    update_by_pk(Division, changed)
+    if changed:
+        cost_data_changed({(Division, pk) for pk in changed})
+
+
+def update_cost_totals(old, new):
+    """
+    Move CostTotal running totals by the difference between two lists of
+    (model, pk, cost, cost_estimate) contributions, as returned by cost_totals
+    Amounts are rounded the same way the database stores them
+    """
+    deltas = {}
+    for sign, contributions in ((-1, old), (1, new)):
+        for model, pk, cost, cost_estimate in contributions:
+            delta = deltas.setdefault((model, pk), [Decimal(0), Decimal(0)])
+            delta[0] += sign * round(Decimal(cost), 2)
+            delta[1] += sign * round(Decimal(cost_estimate), 2)
+    for (model, pk), (cost, cost_estimate) in deltas.items():
+        if pk is not None and (cost or cost_estimate):
+            model.objects.filter(pk=pk).update(
+                total_cost=models.F("total_cost") + cost,
+                total_cost_estimate=models.F("total_cost_estimate") + cost_estimate)
+
+
+def recompute_costs(bills, batch_size=500):
+    """
+    Re-derive the cost split values of a set of bills in one pass, writing
+    changed rows back with a single UPDATE per batch rather than saving each
+    """
+    bills = {bill.pk: bill for bill in bills}
+    changed, old_totals, new_totals = [], [], []
+    costs = [cost for model in (EndUserCost, ITPlatformCost) for cost in model.objects.filter(bill__in=list(bills))]
+    for cost, values in zip(costs, Cost.split(bills, costs)):
+        values += (bills[cost.bill_id].year_id,)
+        if values == (cost.cost, cost.cost_estimate, cost.year_id):
+            continue
+        old_totals += cost.cost_totals()
+        cost.cost, cost.cost_estimate, cost.year_id = values
+        new_totals += cost.cost_totals()
+        changed.append(cost)
+    update_by_pk(Cost, {
+        cost.pk: {"cost": cost.cost, "cost_estimate": cost.cost_estimate, "year_id": cost.year_id} for cost in changed},
+        batch_size)
+    update_cost_totals(old_totals, new_totals)
+    return changed
+
+
+def update_by_pk(model, values, batch_size=500):
+    """
+    Write {pk: {attname: value}} to the rows of a model with a single UPDATE
+    per batch rather than saving each, without running any hooks
+    """
+    pks = list(values)
+    for start in range(0, len(pks), batch_size):
+        batch = pks[start:start + batch_size]
+        updates = {}
+        for name in {name for pk in batch for name in values[pk]}:
+            field = model._meta.get_field(name)
+            updates[field.name] = models.Case(
+                *[models.When(pk=pk, then=models.Value(values[pk][name])) for pk in batch if name in values[pk]],
+                default=models.F(field.name), output_field=field.target_field if field.is_relation else field)
+        model.objects.filter(pk__in=batch).update(**updates)
+
+
+def bulk_insert(model, objects, batch_size=500):
+    """
+    bulk_create, setting the ids of the new rows on every backend
+    """
+    objects = model.objects.bulk_create(objects, batch_size)
+    if objects and objects[0].pk is None:
+        # Only PostgreSQL returns ids from bulk inserts, elsewhere the new rows have the highest ids
+        ids = sorted(model.objects.order_by("-pk").values_list("pk", flat=True)[:len(objects)])
+        for obj, pk in zip(objects, ids):
+            obj.pk = pk
+    return objects
+
+
+def bulk_create_costs(costs, batch_size=500):
+    """
+    Insert unsaved EndUserCost/ITPlatformCost rows without saving each one
+    bulk_create doesn't support multi-table inheritance, so the Cost rows are
+    bulk created first and the child rows inserted against their ids
+    Values are stored as given and no totals are moved (see recompute_costs)
+    """
+    for cost in costs:
+        cost.year_id = cost.bill.year_id
+    parents = bulk_insert(Cost, [
+        Cost(**{field.attname: getattr(cost, field.attname) for field in Cost._meta.concrete_fields if not field.primary_key})
+        for cost in costs], batch_size)
+    for cost, parent in zip(costs, parents):
+        cost.pk = cost.id = parent.pk
+    quote = connection.ops.quote_name
+    with connection.cursor() as cursor:
+        for model in (EndUserCost, ITPlatformCost):
+            fields = model._meta.local_concrete_fields
+            rows = [
+                [field.get_db_prep_save(getattr(cost, field.attname), connection) for field in fields]
+                for cost in costs if type(cost) is model]
+            if rows:
+                cursor.executemany("INSERT INTO {} ({}) VALUES ({})".format(
+                    quote(model._meta.db_table), ", ".join(quote(field.column) for field in fields),
+                    ", ".join(["%s"] * len(fields))), rows)
+    return costs
+
 
 @receiver(post_save)
 def post_save_hook(sender, instance, **kwargs):
     if 'raw' in kwargs and kwargs['raw']:
+        if is_cost_data(sender):
+            cost_data_changed()
         return
+    if (hasattr(instance, "cost_totals")):
+        update_cost_totals(instance.__dict__.pop("_saved_cost_totals", []), instance.cost_totals())
     if (hasattr(instance, "post_save")):
         instance.post_save()
+    if is_cost_data(sender):
+        # After post_save, outside a transaction the work it schedules runs at once
+        nodes = graph_nodes(instance) | instance.__dict__.pop("_saved_nodes", set())
+        if hasattr(instance, "linked_nodes"):
+            nodes |= instance.linked_nodes()
+        cost_data_changed(nodes)
 
 
 @receiver(pre_save)
@@ -353,3 +948,37 @@ def pre_save_hook(sender, instance, **kwargs):
         return
     if (hasattr(instance, "pre_save")):
         instance.pre_save()
+    if is_cost_data(sender) or hasattr(instance, "cost_totals"):
+        saved = sender.objects.filter(pk=instance.pk).first() if instance.pk else None
+        # Nodes the row linked to before, which it may no longer
+        instance._saved_nodes = graph_nodes(saved) if saved else set()
+        if (hasattr(instance, "cost_totals")):
+            instance._saved_cost_totals = saved.cost_totals() if saved else []
+
+
+@receiver(m2m_changed)
+def m2m_changed_hook(sender, instance, action, **kwargs):
+    if action in ("post_add", "post_remove", "post_clear") and is_cost_data(type(instance)):
+        # Clearing gives no pk_set, Allocation.refresh finds the old links itself
+        cost_data_changed(graph_nodes(instance) | {(kwargs["model"], pk) for pk in kwargs["pk_set"] or ()})
+
+
+@receiver(pre_delete)
+def pre_delete_hook(sender, instance, **kwargs):
+    if (hasattr(instance, "cost_totals")):
+        # As stored, the instance's derived values may be older
+        saved = sender.objects.filter(pk=instance.pk).first()
+        instance._saved_cost_totals = saved.cost_totals() if saved else []
+
+
+@receiver(post_delete)
+def post_delete_hook(sender, instance, **kwargs):
+    if (hasattr(instance, "cost_totals")):
+        update_cost_totals(instance.__dict__.pop("_saved_cost_totals", []), [])
+    if (hasattr(instance, "post_delete")):
+        instance.post_delete()
+    if is_cost_data(sender):
+        nodes = graph_nodes(instance)
+        if hasattr(instance, "linked_nodes"):
+            nodes |= instance.linked_nodes()
+        cost_data_changed(nodes)
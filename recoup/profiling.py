@@ -0,0 +1,49 @@
+from django.db import connection
+import time
+
+
+class Profile(object):
+    """
+    Records the SQL statements run on the default connection and the wall
+    time spent inside the block, without needing DEBUG
+    """
+    def __init__(self, slowest=3):
+        self.slowest = slowest
+        self.statements = []
+        self.total = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.statements.append((time.perf_counter() - start, sql))
+
+    def __enter__(self):
+        self.wrapper = connection.execute_wrapper(self)
+        self.wrapper.__enter__()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.total = time.perf_counter() - self.start
+        self.wrapper.__exit__(*exc_info)
+
+    @property
+    def queries(self):
+        return len(self.statements)
+
+    @property
+    def sql_time(self):
+        return sum(duration for duration, sql in self.statements)
+
+    def summary(self):
+        return {
+            "queries": self.queries,
+            "sql_ms": round(self.sql_time * 1000, 1),
+            "python_ms": round((self.total - self.sql_time) * 1000, 1),
+            "total_ms": round(self.total * 1000, 1),
+            "slowest": [
+                {"ms": round(duration * 1000, 1), "sql": sql}
+                for duration, sql in sorted(self.statements, key=lambda s: s[0], reverse=True)[:self.slowest]],
+        }
@@ -0,0 +1,62 @@
+from django.db import transaction
+import threading
+
+_state = threading.local()
+
+
+class Batch(object):
+    """
+    Work scheduled during one transaction: the keys collected for each task
+    """
+    def __init__(self):
+        self.tasks, self.last = {}, {}
+        self.running = False
+
+    def run(self):
+        self.running = True
+        try:
+            while self.tasks or self.last:
+                tasks = self.tasks or self.last
+                task = next(iter(tasks))
+                task(list(tasks.pop(task)))
+        finally:
+            if getattr(_state, "batch", None) is self:
+                _state.batch = None
+
+
+def current():
+    """
+    The batch of work scheduled in the current transaction, or running now
+    """
+    batch = getattr(_state, "batch", None)
+    if batch is not None and not batch.running and not any(
+            func == batch.run for sids, func in transaction.get_connection().run_on_commit):
+        # Registered in a transaction or savepoint since rolled back
+        return None
+    return batch
+
+
+def pending():
+    """
+    Whether the current transaction has written cost data not yet committed
+    (or whose work is still running), see models.cost_data_changed
+    """
+    return current() is not None
+
+
+def schedule(task, keys, last=False):
+    """
+    Run task(keys) once when the current transaction commits, with every key
+    scheduled for it until then, instead of once per save. Outside a
+    transaction it runs at once. Tasks scheduled while the batch runs join it,
+    those scheduled with last run after every other
+    """
+    batch = current()
+    new = batch is None
+    if new:
+        batch = _state.batch = Batch()
+    pending = (batch.last if last else batch.tasks).setdefault(task, {})
+    for key in keys:
+        pending[key] = None
+    if new:
+        transaction.on_commit(batch.run)
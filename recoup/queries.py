@@ -0,0 +1,89 @@
+from django.db.models import Count, DecimalField, F, FloatField, IntegerField, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+from recoup import models
+
+MONEY = DecimalField(max_digits=14, decimal_places=2)
+
+
+def related_aggregate(queryset, field, aggregate, output_field, default=0):
+    """
+    Correlated subquery aggregating the rows of queryset whose field points at the outer row
+    """
+    subquery = Subquery(
+        queryset.filter(**{field: OuterRef("pk")}).order_by().values(field).annotate(
+            value=aggregate).values("value"), output_field=output_field)
+    return subquery if default is None else Coalesce(subquery, default)
+
+
+def allocated(field, amount, **filters):
+    """
+    Correlated subquery summing an amount of the current financial year's
+    allocation ledger rows (see models.LedgerEntry) whose field points at the
+    outer row, so lists can be sorted and filtered on values split to the
+    cent by the allocation kernel (see recoup.kernel)
+    """
+    entries = models.LedgerEntry.objects.filter(year=models.FinancialYear.current(), **filters)
+    return related_aggregate(entries, field, Sum(amount), MONEY)
+
+
+def year_totals():
+    year = models.FinancialYear.current()
+    years = models.FinancialYear.objects.filter(pk=year.pk if year else None)
+    return {
+        "_year_cost": Subquery(years.values("total_cost")[:1], output_field=MONEY),
+        "_year_cost_estimate": Subquery(years.values("total_cost_estimate")[:1], output_field=MONEY),
+    }
+
+
+def systems_with_dependencies():
+    return models.ITSystem.objects.filter(pk__in=models.SystemDependency.objects.values("system_id"))
+
+
+def with_costs(queryset):
+    """
+    Annotate a queryset with the values of its model's cost methods for the
+    current financial year, computed by the database in the same query, with
+    values split between systems or divisions summed from the ledger.
+    Annotations are named _<method name> so the model methods return them
+    (see models.precomputed)
+    """
+    model = queryset.model
+    if issubclass(model, models.CostTotal):
+        queryset = queryset.annotate(_cost=F("total_cost"), _cost_estimate=F("total_cost_estimate"))
+    if model is models.Division:
+        return queryset.annotate(
+            _cc_count=related_aggregate(models.CostCentre.objects.all(), "division", Count("*"), IntegerField()),
+            _system_count=related_aggregate(systems_with_dependencies(), "division", Count("*"), IntegerField()),
+            _cost=allocated("division", "cost"),
+            _cost_estimate=allocated("division", "cost_estimate"),
+            _enduser_cost=allocated("division", "cost", service__isnull=False),
+            _enduser_estimate=allocated("division", "cost_estimate", service__isnull=False),
+            _system_cost=allocated("division", "cost", system__isnull=False),
+            _system_cost_estimate=allocated("division", "cost_estimate", system__isnull=False),
+            **year_totals())
+    if model is models.CostCentre:
+        return queryset.annotate(
+            _system_count=related_aggregate(systems_with_dependencies(), "cost_centre", Count("*"), IntegerField()),
+            _system_cost=allocated("cost_centre", "cost"),
+            _system_cost_estimate=allocated("cost_centre", "cost_estimate"))
+    if model is models.ITSystem:
+        return queryset.annotate(
+            _cost=allocated("system", "cost"), _cost_estimate=allocated("system", "cost_estimate"), **year_totals())
+    if model is models.Platform:
+        return queryset.annotate(
+            _system_count=related_aggregate(models.SystemDependency.objects.all(), "platform", Count("*"), IntegerField()),
+            _system_weight_total=related_aggregate(
+                models.SystemDependency.objects.all(), "platform", Sum("weighting"), FloatField(), default=None),
+            **year_totals())
+    if model is models.EndUserService:
+        return queryset.annotate(
+            _total_user_count=related_aggregate(
+                models.Division.objects.all(), "enduserservice", Sum("user_count"), IntegerField(), default=None),
+            **year_totals())
+    if model is models.Bill:
+        return queryset.annotate(
+            _allocated=related_aggregate(models.Cost.objects.all(), "bill", Sum("percentage"), MONEY))
+    if model is models.ServicePool:
+        return queryset.annotate(**year_totals())
+    return queryset
@@ -0,0 +1,203 @@
+from django.conf import settings
+import glob
+import os
+import xlsxwriter
+
+from recoup import models
+from recoup.allocation import Allocation
+
+
+def duc_report(output, year=None):
+    """
+    Write the DUC report workbook for a financial year (by default the current
+    one) to a file-like object
+    Uses xlsxwriter's constant memory mode, so every worksheet is written
+    strictly row by row and large querysets are iterated without caching
+    """
+    with xlsxwriter.Workbook(output, {'constant_memory': True}) as workbook:
+        bold = workbook.add_format({'bold': True})
+        bold_big_font = workbook.add_format({'bold': True, 'align': 'center'})
+        bold_big_font.set_font_size(14)
+        bold_italic = workbook.add_format({'bold': True, 'italic': True})
+        pct = workbook.add_format({'num_format': '0.00%'})
+        pct_bold = workbook.add_format({'num_format': '0.00%', 'bold': True})
+        pct_bold_italic = workbook.add_format({'num_format': '0.00%', 'bold': True, 'italic': True})
+        money = workbook.add_format({'num_format': '#,##0.00'})
+        money_bold = workbook.add_format({'num_format': '#,##0.00', 'bold': True})
+        money_bold_italic = workbook.add_format({'num_format': '#,##0.00', 'bold': True, 'italic': True})
+
+        year = year or models.FinancialYear.current()
+        allocation = Allocation.load(year)
+        divisions = allocation.apply(list(models.Division.objects.prefetch_related('costcentre_set')))
+        for division in divisions:
+            allocation.apply(division.costcentre_set.all())
+        services = allocation.apply(list(models.EndUserService.objects.all()))
+
+        # Statement worksheet
+        invoice = workbook.add_worksheet('Statement')
+        invoice.write_row('A1', (
+            'Division / Cost Centre', 'Computer User Accounts', 'End User Services ($)',
+            'Business IT Systems ($)', 'Total DUC Estimated Cost ($)'))
+        invoice.set_row(0, None, bold_big_font)
+        # User counts as allocated, frozen with the costs once the year is closed
+        user_count = sum(allocation.get(division, 'user_count', 0) for division in divisions)
+        enduser_total = allocation.total(models.EndUserService, 'cost_estimate')
+        platform_cost = round(allocation.total(models.Platform, 'cost_estimate'), 2)
+        # Insert total row at the top
+        invoice.write('A2', 'Total', bold_italic)
+        invoice.write('B2', user_count, bold_italic)
+        invoice.write('C2', enduser_total, money_bold_italic)
+        invoice.write('D2', platform_cost, money_bold_italic)
+        invoice.write('E2', enduser_total + platform_cost, money_bold_italic)
+        row = 2
+        divrow = 2
+        for division in divisions:
+            invoice.write(row, 0, division.name, bold)
+            invoice.write(row, 1, allocation.get(division, 'user_count', 0), bold)
+            invoice.write(row, 2, division.enduser_estimate(), money_bold)
+            invoice.write(row, 3, division.system_cost_estimate(), money_bold)
+            invoice.write(row, 4, division.enduser_estimate() + division.system_cost_estimate(), money_bold)
+            divrow = row
+            row += 1
+            for cc in division.costcentre_set.all():
+                invoice.write_row(row, 0, [
+                    cc.name, allocation.get(cc, 'user_count', 0), '=B{}*C{}/B{}'.format(row + 1, divrow + 1, divrow + 1),
+                    cc.system_cost_estimate(), '=SUM(C{},D{})'.format(row + 1, row + 1)])
+                row += 1
+        invoice.set_column('A:A', 34)
+        invoice.set_column('B:B', 28)
+        invoice.set_column('C:D', 27, money)
+        invoice.set_column('E:E', 33, money)
+
+        # Computer user account worksheet
+        staff = workbook.add_worksheet('User Accounts')
+        staff.write_row('A1', ('Division / Cost Centre', 'Computer User Accounts', '% Total'))
+        staff.set_row(0, None, bold_big_font)
+        # Insert total row at the top
+        staff.write('A2', 'Total', bold_italic)
+        staff.write('B2', user_count, bold_italic)
+        staff.write('C2', 1, pct_bold_italic)
+        row = 2
+        for division in divisions:
+            staff.write(row, 0, division.name, bold)
+            staff.write(row, 1, allocation.get(division, 'user_count', 0), bold)
+            staff.write(row, 2, division.user_count_percentage() / 100, pct_bold)
+            row += 1
+            for cc in division.costcentre_set.all():
+                staff.write_row(row, 0, [cc.name, allocation.get(cc, 'user_count', 0), cc.user_count_percentage() / 100])
+                row += 1
+        staff.set_column('A:A', 35)
+        staff.set_column('B:B', 30)
+        staff.set_column('C:C', 10, pct)
+
+        # End User services worksheet
+        enduser = workbook.add_worksheet('End-User Services')
+        enduser.write_row('A1', ('End-User Services', 'Estimated Cost ($)'))
+        enduser.set_row(0, None, bold_big_font)
+        # Insert total row at the top
+        enduser.write('A2', 'Total', bold_italic)
+        enduser.write('B2', enduser_total, money_bold_italic)
+        row = 2
+        for service in services:
+            enduser.write_row(row, 0, [service.name, service.cost_estimate()])
+            row += 1
+        enduser.set_column('A:A', 40)
+        enduser.set_column('B:B', 22, money)
+
+        # Business IT systems worksheet
+        itsystems = workbook.add_worksheet('Business IT Systems')
+        itsystems.write_row('A1', ('Division / Cost Centre', 'Business IT Systems', 'Estimated Cost ($)', '% Total'))
+        itsystems.set_row(0, None, bold_big_font)
+        # Insert total row at the top
+        itsystems.write('A2', 'Total', bold_italic)
+        itsystems.write('B2', 'All IT Systems', bold_italic)
+        itsystems.write('C2', platform_cost, money_bold_italic)
+        itsystems.write('D2', 1, pct_bold_italic)
+        # Rows rather than model instances, costs read from the allocation by pk
+        systems = models.ITSystem.objects.filter(
+            pk__in=models.SystemDependency.objects.values('system_id')).order_by(
+            'division__position', 'cost_centre__name', 'name').values_list(
+            'pk', 'division_id', 'cost_centre__name', 'name', 'system_id').iterator()
+        system = next(systems, None)
+        row = 2
+        for division in divisions:
+            itsystems.write(row, 0, division.name, bold)
+            itsystems.write(row, 1, 'Subtotal', bold)
+            itsystems.write(row, 2, division.system_cost_estimate(), money_bold)
+            itsystems.write(row, 3, '=C{}/C2'.format(row + 1), pct_bold)
+            row += 1
+            while system is not None and system[1] == division.pk:
+                pk, division_id, cost_centre, name, system_id = system
+                itsystems.write_row(row, 0, [
+                    cost_centre, '{} (#{})'.format(name, system_id),
+                    allocation.node(models.ITSystem, pk)['cost_estimate'], '=C{}/C2'.format(row + 1)])
+                row += 1
+                system = next(systems, None)
+        itsystems.set_column('A:A', 35)
+        itsystems.set_column('B:B', 68)
+        itsystems.set_column('C:C', 22, money)
+        itsystems.set_column('D:D', 10, pct)
+
+        # Bill worksheet
+        bills = workbook.add_worksheet('Bills')
+        bills.write_row('A1', (
+            'Brand', 'Vendor', 'Description', 'Contract Reference', 'Quantity', 'Renewal Date',
+            'Estimated Cost ($)', 'Comment'))
+        bills.set_row(0, None, bold_big_font)
+        row = 1
+        for brand, vendor, name, reference, quantity, renewal_date, cost_estimate, comment in models.Bill.objects.filter(
+                year=year, active=True, cost_estimate__gt=0).order_by('contract__brand', 'contract__vendor', 'name').values_list(
+                'contract__brand', 'contract__vendor', 'name', 'contract__reference', 'quantity', 'renewal_date',
+                'cost_estimate', 'comment').iterator():
+            bills.write_row(row, 0, [
+                brand, vendor, name, reference, quantity, renewal_date.isoformat() if renewal_date else 'N/A',
+                cost_estimate, comment])
+            row += 1
+        bills.set_column('A:B', 22)
+        bills.set_column('C:C', 78)
+        bills.set_column('D:D', 36)
+        bills.set_column('E:E', 10)
+        bills.set_column('F:F', 16)
+        bills.set_column('G:G', 20, money)
+        bills.set_column('H:H', 60)
+
+        # Cost Breakdown worksheet
+        costs = workbook.add_worksheet('Cost Breakdown')
+        costs.write_row('A1', (
+            'Category', 'Type', 'Brand', 'Vendor', 'Contract Reference', 'Description (1)',
+            'Description (2)', 'Service Pool', 'Percentage', 'Estimate Cost ($)'))
+        costs.set_row(0, None, bold_big_font)
+        row = 1
+        for category, model, target in (('End-User Services', models.EndUserCost, 'service'), ('IT Platform', models.ITPlatformCost, 'platform')):
+            for values in model.objects.filter(year=year).order_by(
+                    '{}__name'.format(target), 'bill__contract__brand', 'bill__contract__vendor', 'bill__name').values_list(
+                    '{}__name'.format(target), 'bill__contract__brand', 'bill__contract__vendor', 'bill__contract__reference',
+                    'name', 'bill__name', 'service_pool__name', 'percentage', 'cost_estimate').iterator():
+                costs.write_row(row, 0, (category,) + values[:7] + (values[7] / 100, values[8]))
+                row += 1
+        costs.set_column('A:A', 20)
+        costs.set_column('B:B', 28)
+        costs.set_column('C:D', 22)
+        costs.set_column('E:G', 30)
+        costs.set_column('H:H', 17)
+        costs.set_column('I:I', 17, pct)
+        costs.set_column('J:J', 20, money)
+
+
+REPORTS = {
+    'DUCReport': duc_report,
+}
+
+
+def build_report(job):
+    """
+    Write the artifact for a ReportJob, replacing those built from older data
+    """
+    os.makedirs(settings.REPORT_ROOT, exist_ok=True)
+    partial = '{}.partial'.format(job.path)
+    with open(partial, 'wb') as output:
+        REPORTS[job.report](output, job.year)
+    os.rename(partial, job.path)
+    for path in glob.glob(models.ReportJob.artifact_path(job.report, job.year_id, '*')):
+        if path != job.path:
+            os.remove(path)
@@ -1,3 +1,525 @@
-from django.test import TestCase
+from collections import defaultdict
+from datetime import timedelta
+from decimal import Decimal
+from django.contrib.auth import get_user_model
+from django.core.exceptions import ValidationError
+from django.core.management import CommandError, call_command
+from django.db import transaction
+from django.db.models import F
+from django.test import Client, SimpleTestCase, TransactionTestCase, override_settings
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.utils import timezone
+from django.utils.text import slugify
+import io
+import json
+import numpy as np
+import os
+import reversion
+from reversion.models import Revision
+import shutil
+import tempfile
+import zipfile
 
-# Create your tests here.
+from recoup import kernel, ledger, models, propagation, reports, warmup
+from recoup.allocation import Allocation, load_data, rebuild_cost_totals
+from recoup.diff import revision_diff
+from recoup.graph import Nodes
+from recoup.imports import Importer, UserCountSync, read_rows
+from recoup.invoices import invoice_contexts, invoice_numbers
+from recoup.middleware import QueryBudgetExceeded
+
+
+def generate(**counts):
+    """
+    Fill the test database with a small synthetic dataset, see generate_data
+    """
+    options = dict(
+        divisions=3, cost_centres=12, systems=40, platforms=6, services=3, pools=2, contracts=8, bills=30)
+    options.update(counts)
+    call_command("generate_data", stdout=io.StringIO(), **options)
+
+
+class DataTestCase(TransactionTestCase):
+    """
+    Saves propagate on commit (see recoup.propagation), so tests commit
+    rather than running in a transaction rolled back at the end. Shared
+    allocations and reports are kept in a temporary directory
+    """
+    def setUp(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root, ignore_errors=True)
+        settings = override_settings(
+            ALLOCATION_ROOT=os.path.join(root, "allocations"), REPORT_ROOT=os.path.join(root, "reports"))
+        settings.enable()
+        self.addCleanup(settings.disable)
+        generate()
+
+    def split_bill(self):
+        return next(bill for bill in models.Bill.objects.filter(active=True) if bill.cost_items.count() > 1)
+
+    def edit(self):
+        """
+        Commit a change to each kind of cost data: a bill's estimate, a
+        dependency's weighting, a cost centre's user count and a vendor
+        """
+        bill = self.split_bill()
+        bill.cost_estimate += 12345
+        bill.save()
+        dependency = models.SystemDependency.objects.order_by("pk").first()
+        dependency.weighting += 2
+        dependency.save()
+        cost_centre = models.CostCentre.objects.order_by("pk").first()
+        cost_centre.user_count += 7
+        cost_centre.save()
+        contract = bill.contract
+        contract.vendor = "Renamed Vendor"
+        contract.save()
+
+    def edit_structure(self):
+        # The changes of edit that aren't to a year's bills
+        dependency = models.SystemDependency.objects.order_by("pk").first()
+        dependency.weighting += 2
+        dependency.save()
+        cost_centre = models.CostCentre.objects.order_by("pk").first()
+        cost_centre.user_count += 7
+        cost_centre.save()
+
+    def save_in_revision(self, bill):
+        # As the admin saves a bill and its inline cost splits
+        with reversion.create_revision():
+            bill.save()
+            for model in (models.EndUserCost, models.ITPlatformCost):
+                for cost in model.objects.filter(bill=bill):
+                    cost.save()
+        return Revision.objects.latest("pk")
+
+
+class RevisionDiffTests(DataTestCase):
+    def test_bill_estimate_change(self):
+        bill = self.split_bill()
+        before = self.save_in_revision(bill)
+        allocated = models.field_sum(bill.cost_items.all(), "cost_estimate")
+        bill.cost_estimate += 20000
+        after = self.save_in_revision(bill)
+        moved = models.field_sum(bill.cost_items.all(), "cost_estimate") - allocated
+        self.assertGreater(moved, 0)
+        # So that after is read from its versions, not taken as the data now
+        self.save_in_revision(bill)
+        diff = revision_diff(before, after)
+        self.assertEqual([change.key for change in diff.bills], [bill.pk])
+        self.assertEqual(len(diff.splits), bill.cost_items.count())
+        self.assertEqual(sum(change.delta[1] for change in diff.splits), moved)
+        changed = {change.key[0] for change in diff.nodes}
+        self.assertTrue({models.Contract, models.ServicePool, models.Division}.issubset(changed))
+        self.assertTrue(changed.intersection({models.Platform, models.EndUserService}))
+        self.assertEqual(
+            [change.key for change in revision_diff(before).splits], [change.key for change in diff.splits])
+
+
+class KernelTests(SimpleTestCase):
+    def test_apportion_adds_up(self):
+        rand = np.random.RandomState(0)
+        totals = rand.randint(0, 10 ** 8, 50)
+        groups = np.sort(rand.randint(0, 50, 400))
+        weights = rand.randint(1, 1000, 400)
+        parts = kernel.apportion(totals, groups, weights)
+        self.assertEqual(np.bincount(groups, weights=parts, minlength=50).astype(np.int64).tolist(), [
+            total if (groups == group).any() else 0 for group, total in enumerate(totals.tolist())])
+        exact = totals[groups] * weights / np.bincount(groups, weights=weights, minlength=50)[groups]
+        self.assertTrue((np.abs(parts - exact) < 1).all())
+
+    def test_ties_go_to_lowest_key(self):
+        self.assertEqual(kernel.apportion([100], [0, 0, 0], [1, 1, 1]).tolist(), [34, 33, 33])
+        self.assertEqual(kernel.apportion([100], [0, 0, 0], [1, 1, 1], [3, 1, 2]).tolist(), [33, 34, 33])
+        self.assertEqual(kernel.share(Decimal("0.02"), [1, 1, 1], 2, [3, 1, 2]), Decimal("0.01"))
+
+    def test_zero_weights(self):
+        self.assertEqual(kernel.apportion([100, 7], [0, 0, 1], [0, 0, 1]).tolist(), [0, 0, 7])
+
+
+class AllocationTests(DataTestCase):
+    def test_refresh_matches_full_load(self):
+        year = models.FinancialYear.current()
+        Allocation.load(year)
+        self.edit()
+        refreshed = Allocation.refreshed(year, models.DataVersion.current())
+        self.assertIsNotNone(refreshed)
+        full = Allocation(load_data(year))
+        self.assertEqual(refreshed.nodes, full.nodes)
+        self.assertEqual(refreshed.division_services, full.division_services)
+        self.assertEqual(Allocation.load(year).nodes, full.nodes)
+
+    def test_shared_file_matches_computed(self):
+        computed = Allocation(load_data())
+        shared = Allocation.load()
+        self.assertIsInstance(shared.nodes, Nodes)
+        self.assertEqual(shared.nodes, computed.nodes)
+        self.assertEqual(shared.division_services, computed.division_services)
+        for model in (models.Platform, models.EndUserService):
+            self.assertEqual(shared.total(model, "cost"), computed.total(model, "cost"))
+        for division in models.Division.objects.all():
+            self.assertEqual(shared.values(division), computed.values(division))
+        # Rows added since have no node, as with a computed allocation
+        self.assertEqual(shared.get(models.Division(pk=0), "cost"), Decimal(0))
+
+    @override_settings(ALLOCATION_ROOT="")
+    def test_changes_pruned(self):
+        history = models.DirtyNode.HISTORY
+        models.DataVersion.objects.update(version=2 * history - 2)
+        models.DirtyNode.objects.bulk_create(
+            [models.DirtyNode(version=version) for version in (1, history, history + 1)])
+        self.edit()
+        self.assertGreater(models.DataVersion.current(), 2 * history)
+        self.assertEqual(min(models.DirtyNode.objects.values_list("version", flat=True)), history + 1)
+
+
+class PropagationTests(DataTestCase):
+    def test_saves_coalesced_on_commit(self):
+        version = models.DataVersion.current()
+        bills = list(models.Bill.objects.filter(active=True, cost_items__isnull=False).distinct()[:3])
+        with transaction.atomic():
+            for bill in bills:
+                bill.cost_estimate += 1000
+                bill.save()
+            self.assertTrue(propagation.pending())
+            self.assertEqual(models.DataVersion.current(), version)
+        self.assertFalse(propagation.pending())
+        # One batch, recording every node the saves changed under a single version
+        self.assertEqual(models.DataVersion.current(), version + 1)
+        changed = set(models.DirtyNode.objects.filter(version=version + 1).values_list("model", "object_id"))
+        self.assertTrue({("contract", bill.contract_id) for bill in bills}.issubset(changed))
+        self.assertEqual(rebuild_cost_totals(check=True), [])
+        self.assertEqual(ledger.check(), [])
+
+    def test_rolled_back_saves_not_propagated(self):
+        version = models.DataVersion.current()
+        bill = self.split_bill()
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                bill.cost_estimate += 1000
+                bill.save()
+                raise ValueError
+        self.assertFalse(propagation.pending())
+        self.assertEqual(models.DataVersion.current(), version)
+
+
+class BenchmarkTests(DataTestCase):
+    def test_benchmark(self):
+        with self.assertRaises(CommandError):
+            call_command("benchmark", stdout=io.StringIO())
+        # As left by a killed run
+        get_user_model().objects.create_superuser("benchmark", "benchmark@example.com", None)
+        estimates = dict(models.Bill.objects.values_list("pk", "cost_estimate"))
+        # Which the command sets up itself, as run outside the test runner
+        teardown_test_environment()
+        self.addCleanup(setup_test_environment)
+        output = io.StringIO()
+        call_command("benchmark", allow_writes=True, repeat=1, stdout=output, stderr=io.StringIO())
+        results = json.loads(output.getvalue())
+        self.assertTrue({"HomePageView", "DUCReport", "admin:bill", "Bill.save"}.issubset(results))
+        self.assertFalse(get_user_model().objects.filter(username="benchmark").exists())
+        self.assertEqual(dict(models.Bill.objects.values_list("pk", "cost_estimate")), estimates)
+
+
+class LedgerTests(DataTestCase):
+    def test_check_after_edits(self):
+        self.edit()
+        models.Cost.objects.filter(pk=self.split_bill().cost_items.first().pk).delete()
+        self.assertEqual(ledger.check(), [])
+        call_command("rebuild_ledger", check=True, stdout=io.StringIO())
+        models.LedgerEntry.objects.filter(pk=models.LedgerEntry.objects.first().pk).update(cost=F("cost") + 1)
+        with self.assertRaises(CommandError):
+            call_command("rebuild_ledger", check=True, stdout=io.StringIO())
+        call_command("rebuild_ledger", stdout=io.StringIO())
+        self.assertEqual(ledger.check(), [])
+
+    def test_totals_match_allocation(self):
+        self.edit()
+        allocation = Allocation(load_data())
+        totals = defaultdict(Decimal)
+        for system, division, cost in models.LedgerEntry.objects.filter(
+                year=models.FinancialYear.current()).values_list("system", "division", "cost"):
+            totals[(models.ITSystem, system)] += cost
+            totals[(models.Division, division)] += cost
+        for model in (models.ITSystem, models.Division):
+            for obj in model.objects.all():
+                self.assertEqual(totals[(model, obj.pk)], allocation.get(obj, "cost"), obj)
+
+
+class ImportTests(DataTestCase):
+    def test_missing_columns(self):
+        with self.assertRaisesMessage(ValidationError, "Missing columns: bill"):
+            read_rows("bills.csv", io.BytesIO(b"Vendor,Cost\nAcme,1\n"))
+
+    def test_invalid_rows_write_nothing(self):
+        bills = models.Bill.objects.count()
+        rows = read_rows("bills.csv", io.BytesIO(
+            b"vendor,bill,cost,split,percentage,service_pool,platform\n"
+            b"Acme,Licences,lots,platform,50,No Such Pool,\n"
+            b"Acme,Support,100,platform,150,,\n"
+            b",Hosting,100,,,,\n"))
+        with self.assertRaises(ValidationError) as raised:
+            Importer(rows, models.FinancialYear.current()).save()
+        self.assertEqual(raised.exception.messages, [
+            "Row 2: cost is not a number: lots",
+            "Row 2: service_pool \"No Such Pool\" does not exist",
+            "Row 2: platform \"\" does not exist",
+            "Row 3: percentage must be between 0 and 100: 150",
+            "Row 3: service_pool \"\" does not exist",
+            "Row 3: platform \"\" does not exist",
+            "Row 4: vendor and bill are required"])
+        self.assertEqual(models.Bill.objects.count(), bills)
+
+    def test_user_count_errors(self):
+        code = models.CostCentre.objects.order_by("pk").first().code
+        sync = UserCountSync([
+            {"code": code, "user_count": "1.5"}, {"code": code, "user_count": 3}, {"code": code, "user_count": 4},
+            {"code": "", "user_count": 1}])
+        with self.assertRaises(ValidationError) as raised:
+            sync.save()
+        self.assertEqual(raised.exception.messages, [
+            "Row 2: user_count is not a whole number of users: 1.5",
+            "Row 4: cost centre {} is listed more than once".format(code),
+            "Row 5: code is required"])
+        self.assertEqual(UserCountSync([{"code": "NOPE", "user_count": 1}]).save(), (0, ["NOPE"]))
+
+
+class YearTests(DataTestCase):
+    def assertTotals(self, year):
+        for contract in models.Contract.objects.all():
+            self.assertEqual(contract.total_cost_estimate, models.field_sum(
+                contract.bill_set.filter(year=year, active=True), "cost_estimate"), contract)
+
+    def test_rollover(self):
+        year = models.FinancialYear.current()
+        totals = (year.total_cost, year.total_cost_estimate)
+        bills = list(year.bill_set.filter(active=True).order_by("name"))
+        call_command("rollover_year", uplift=Decimal(10), stdout=io.StringIO())
+        new_year = models.FinancialYear.objects.last()
+        self.assertEqual(new_year.start, models.next_year(year.start))
+        copies = list(new_year.bill_set.order_by("name"))
+        self.assertEqual([bill.name for bill in copies], [bill.name for bill in bills])
+        for bill, copy in zip(bills, copies):
+            self.assertEqual(copy.cost_estimate, round(bill.cost_estimate * Decimal("1.1"), 2))
+            self.assertEqual(
+                sorted(copy.cost_items.values_list("service_pool", "year")),
+                sorted((pool, new_year.pk) for pool in bill.cost_items.values_list("service_pool", flat=True)))
+        self.assertEqual(new_year.total_cost_estimate, models.field_sum(new_year.bill_set.all(), "cost_estimate"))
+        year.refresh_from_db()
+        self.assertEqual((year.total_cost, year.total_cost_estimate), totals)
+        with self.assertRaises(ValidationError):
+            year.rollover()
+        with self.assertRaises(CommandError):
+            call_command("rollover_year", year=year.start.year, stdout=io.StringIO())
+
+    def test_make_current(self):
+        year = models.FinancialYear.current()
+        new_year = year.rollover(Decimal(10))
+        self.assertEqual(models.FinancialYear.current(), year)
+        version = models.DataVersion.current()
+        new_year.make_current()
+        self.assertEqual(models.FinancialYear.current(), new_year)
+        self.assertEqual(list(models.FinancialYear.objects.filter(is_current=True)), [new_year])
+        self.assertGreater(models.DataVersion.current(), version)
+        self.assertTotals(new_year)
+        year.make_current()
+        self.assertTotals(year)
+
+    def test_close_and_reopen(self):
+        year = models.FinancialYear.current()
+        live = Allocation(load_data(year))
+        call_command("close_year", year.start.year, stdout=io.StringIO())
+        year.refresh_from_db()
+        self.assertEqual(year.snapshots.count(), len([key for key in live.nodes if key[1] is not None]))
+        with self.assertRaises(ValidationError):
+            year.close()
+        bill = self.split_bill()
+        with self.assertRaises(ValidationError):
+            bill.full_clean()
+        # Changes outside the year's bills leave its snapshot as it was
+        self.edit_structure()
+        closed = Allocation.load(year)
+        self.assertNotEqual(Allocation(load_data(year)).nodes, live.nodes)
+        for model in (models.Division, models.CostCentre, models.ITSystem, models.Platform, models.EndUserService):
+            for obj in model.objects.all():
+                self.assertEqual(closed.values(obj), live.values(obj), obj)
+        self.assertEqual(closed.division_services, live.division_services)
+        # Divisions added since have no snapshot node, and are reported as zero
+        division = models.Division.objects.create(name="New", user_count=50, position=1000)
+        models.EndUserService.objects.first().divisions.add(division)
+        closed.apply([division])
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                (division.cost_estimate(), division.enduser_estimate(), division.system_cost_estimate()), (0, 0, 0))
+        reports.duc_report(io.BytesIO(), year)
+        year.reopen()
+        self.assertFalse(year.snapshots.exists())
+        self.assertEqual(Allocation.load(year).nodes, Allocation(load_data(year)).nodes)
+        models.Bill.objects.get(pk=bill.pk).full_clean()
+
+
+class AdminTests(DataTestCase):
+    def test_top_estimate_filter(self):
+        client = Client()
+        client.force_login(get_user_model().objects.create_superuser("admin", "admin@example.com", None))
+        allocation = Allocation(load_data())
+        for model, field in (
+                (models.Division, "cost_estimate"), (models.ITSystem, "cost_estimate"),
+                (models.Platform, "cost_estimate"), (models.CostCentre, "system_cost_estimate")):
+            url = "/admin/recoup/{}/?top=5".format(model._meta.model_name)
+            response = client.get(url)
+            self.assertEqual(response.status_code, 200, url)
+            estimates = sorted(
+                (-allocation.get(obj, field), obj.pk) for obj in model.objects.all())[:5]
+            self.assertEqual(
+                sorted(obj.pk for obj in response.context["cl"].result_list),
+                sorted(pk for estimate, pk in estimates), url)
+            self.assertEqual(client.get(url.replace("5", "x")).status_code, 302)
+
+
+@override_settings(QUERY_BUDGET_STRICT=True)
+class QueryBudgetTests(DataTestCase):
+    def test_pages_within_budget(self):
+        client = Client()
+        urls = [
+            "/", "/bill?division={}".format(models.Division.objects.first().pk), "/bills.zip",
+            "/reports/DUCReport.xlsx"]
+        # Cold, then warm, then refreshed after a change
+        for i in range(2):
+            for url in urls:
+                self.assertEqual(client.get(url).status_code, 200, url)
+        self.edit()
+        for url in urls:
+            self.assertEqual(client.get(url).status_code, 200, url)
+
+    @override_settings(QUERY_BUDGETS={"home": 1})
+    def test_over_budget(self):
+        with self.assertRaises(QueryBudgetExceeded):
+            Client().get("/")
+
+
+class ConditionalGetTests(DataTestCase):
+    def test_not_modified_until_data_changes(self):
+        client = Client()
+        for url in ("/", "/bill?division={}".format(models.Division.objects.first().pk), "/reports/DUCReport.xlsx"):
+            response = client.get(url)
+            self.assertEqual(response.status_code, 200, url)
+            etag = response["ETag"]
+            self.assertTrue(response.has_header("Last-Modified"), url)
+            self.assertEqual(client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304, url)
+            self.assertEqual(
+                client.get(url, HTTP_IF_MODIFIED_SINCE=response["Last-Modified"]).status_code, 304, url)
+            self.edit()
+            self.assertEqual(client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200, url)
+
+    @override_settings(REPORT_WORKER=True)
+    def test_queued_report_redirect_has_no_validators(self):
+        client = Client()
+        response = client.get("/reports/DUCReport.xlsx")
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse(response.has_header("ETag"))
+        self.assertFalse(response.has_header("Last-Modified"))
+        etag = '"{}"'.format(models.DataVersion.current())
+        self.assertEqual(client.get("/reports/DUCReport.xlsx", HTTP_IF_NONE_MATCH=etag).status_code, 302)
+        call_command("process_report_jobs", once=True, stdout=io.StringIO())
+        response = client.get("/reports/DUCReport.xlsx")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["ETag"], etag)
+        self.assertEqual(client.get("/reports/DUCReport.xlsx", HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+
+class InvoiceTests(DataTestCase):
+    def test_numbers(self):
+        pks = list(models.Division.objects.values_list("pk", flat=True))
+        numbers = invoice_numbers("INV-0099", "2018-08-31", {pks[1]: ("SPECIAL", None)})
+        self.assertEqual([numbers[pk] for pk in pks], [
+            ("INV-0099", "2018-08-31"), ("SPECIAL", "2018-08-31"), ("INV-0101", "2018-08-31")])
+        self.assertEqual(invoice_numbers()[pks[0]], (None, None))
+        with self.assertRaises(ValidationError):
+            invoice_numbers("INV")
+        self.assertEqual(Client().get("/bills.zip?invoiceno=INV").status_code, 400)
+        with self.assertRaises(CommandError):
+            call_command("batch_invoices", os.devnull, invoiceno="INV", stdout=io.StringIO())
+
+    def test_contexts(self):
+        year = models.FinancialYear.current()
+        contexts = invoice_contexts(year, models.Division.objects.all())
+        shares = defaultdict(Decimal)
+        for context in contexts:
+            division = context["division"]
+            for service in context["services"]:
+                shares[service.pk] += service.cost_estimate_display
+            self.assertEqual({system.division_id for system in context["systems"]}.difference([division.pk]), set())
+            self.assertEqual(
+                sum(system.cost_estimate() for system in context["systems"]), division.system_cost_estimate())
+        for service in models.EndUserService.objects.filter(pk__in=shares):
+            self.assertEqual(shares[service.pk], service.cost_estimate())
+
+    def test_zip(self):
+        path = os.path.join(tempfile.mkdtemp(), "invoices.zip")
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        call_command("batch_invoices", path, invoiceno="0042", due="2018-08-31", processes=1, stdout=io.StringIO())
+        response = Client().get("/bills.zip?invoiceno=0042&due=2018-08-31")
+        self.assertEqual(response.status_code, 200)
+        divisions = list(models.Division.objects.all())
+        with zipfile.ZipFile(path) as archive, zipfile.ZipFile(io.BytesIO(response.content)) as downloaded:
+            self.assertEqual(archive.namelist(), [
+                "{:04d}-{}.html".format(42 + i, slugify(division.name)) for i, division in enumerate(divisions)])
+            self.assertEqual(downloaded.namelist(), archive.namelist())
+            for name, division in zip(archive.namelist(), divisions):
+                html = archive.read(name).decode()
+                self.assertIn(name[:4], html)
+                self.assertIn(division.name, html)
+
+
+class ReadinessTests(DataTestCase):
+    def test_warms_up_in_background(self):
+        self.addCleanup(setattr, warmup, "ready", warmup.ready)
+        warmup.ready = False
+        client = Client()
+        with self.assertNumQueries(0):
+            response = client.get("/readiness")
+        self.assertEqual(response.status_code, 503)
+        warmup._thread.join()
+        self.assertEqual(client.get("/readiness").status_code, 200)
+
+
+class ReportJobTests(DataTestCase):
+    def download(self, response):
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Disposition"], "attachment; filename=DUCReport.xlsx")
+        return b"".join(response.streaming_content)
+
+    def test_built_in_request_without_worker(self):
+        self.assertTrue(self.download(Client().get("/reports/DUCReport.xlsx")).startswith(b"PK"))
+        self.assertFalse(models.ReportJob.objects.exists())
+
+    @override_settings(REPORT_WORKER=True)
+    def test_queued_built_and_served(self):
+        client = Client()
+        response = client.get("/reports/DUCReport.xlsx")
+        job = models.ReportJob.objects.get()
+        self.assertRedirects(response, "/reports/jobs/{}".format(job.pk), fetch_redirect_response=False)
+        # Asking again waits for the same job
+        client.get("/reports/DUCReport.xlsx")
+        self.assertEqual(models.ReportJob.objects.count(), 1)
+        call_command("process_report_jobs", once=True, stdout=io.StringIO())
+        job.refresh_from_db()
+        self.assertEqual(job.status, models.ReportJob.DONE)
+        self.assertContains(client.get("/reports/jobs/{}".format(job.pk)), "Report ready")
+        self.assertEqual(
+            self.download(client.get("/reports/jobs/{}/download".format(job.pk))),
+            self.download(client.get("/reports/DUCReport.xlsx")))
+
+    @override_settings(REPORT_WORKER=True, REPORT_JOB_TIMEOUT=60)
+    def test_stale_job_requeued(self):
+        year = models.FinancialYear.current()
+        job = models.ReportJob.enqueue("DUCReport", year, models.DataVersion.current())
+        running = models.ReportJob.objects.filter(pk=job.pk)
+        running.update(status=models.ReportJob.RUNNING, started=timezone.now())
+        call_command("process_report_jobs", once=True, stdout=io.StringIO())
+        self.assertEqual(running.get().status, models.ReportJob.RUNNING)
+        running.update(started=timezone.now() - timedelta(minutes=2))
+        call_command("process_report_jobs", once=True, stdout=io.StringIO())
+        self.assertEqual(running.get().status, models.ReportJob.DONE)
+        self.assertTrue(os.path.exists(running.get().path))
@@ -0,0 +1,53 @@
+from django.db import connections
+from django.template.loader import get_template
+from django.urls import get_resolver
+import logging
+import threading
+import time
+
+from recoup import models
+from recoup.allocation import Allocation
+
+LOGGER = logging.getLogger('recoup')
+ready = False
+_thread = None
+_lock = threading.Lock()
+
+
+def warm_up():
+    """
+    Import every view and precompute the current financial year's allocation,
+    e.g. in the gunicorn master (see gunicorn.ini) so that forked workers
+    start with them. Returns whether it succeeded
+    """
+    global ready
+    start = time.perf_counter()
+    try:
+        get_resolver().url_patterns
+        for template in ("home.html", "bill.html", "report_job.html", "healthcheck.html"):
+            get_template(template)
+        year = models.FinancialYear.current()
+        if year is not None:
+            Allocation.load(year)
+    except Exception:
+        LOGGER.exception("Warm up failed")
+        return False
+    finally:
+        # Forked workers mustn't share the connection
+        connections.close_all()
+    ready = True
+    LOGGER.info("Warmed up in {:.0f} ms".format((time.perf_counter() - start) * 1000))
+    return True
+
+
+def start():
+    """
+    Warm up in a background thread unless already warm or warming up, e.g.
+    in a worker forked from a master that couldn't (see gunicorn.ini)
+    """
+    global _thread
+    with _lock:
+        if ready or (_thread is not None and _thread.is_alive()):
+            return
+        _thread = threading.Thread(target=warm_up, name="warm-up", daemon=True)
+        _thread.start()
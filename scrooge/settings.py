@@ -34,6 +34,7 @@ INSTALLED_APPS = [
     'recoup'
 ]
 MIDDLEWARE = [
+    'recoup.middleware.ProfilingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -43,6 +44,7 @@ MIDDLEWARE = [
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'dpaw_utils.middleware.SSOLoginMiddleware',
+    'recoup.middleware.MemoMiddleware',
 ]
 TEMPLATES = [
     {
@@ -77,6 +79,34 @@ USE_TZ = True
 STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
 STATIC_URL = '/static/'
 
+# Generated report files (see the process_report_jobs management command)
+REPORT_ROOT = env('REPORT_ROOT', os.path.join(BASE_DIR, 'reports'))
+# Whether a process_report_jobs worker sharing REPORT_ROOT builds queued
+# reports; without one they are built in the request that asks for them
+REPORT_WORKER = env('REPORT_WORKER', False)
+# Seconds after which a running report job is taken to have lost its worker and queued again
+REPORT_JOB_TIMEOUT = env('REPORT_JOB_TIMEOUT', 3600)
+
+# Computed cost allocations shared by every worker process (see recoup.allocation.Allocation.shared)
+# Must be local to the host; set empty to compute them in each request instead
+ALLOCATION_ROOT = env('ALLOCATION_ROOT', os.path.join(BASE_DIR, 'allocations'))
+
+# Per request profiling (see recoup.middleware.ProfilingMiddleware)
+# Query budgets are keyed by URL name, or a glob pattern matching it. Requests
+# over budget log a warning, or raise an exception in strict mode (for tests)
+PROFILE_HEADER = env('PROFILE_HEADER', DEBUG)
+QUERY_BUDGET_STRICT = env('QUERY_BUDGET_STRICT', False)
+QUERY_BUDGETS = {
+    'home': 15,
+    'bill': 20,
+    'bills_zip': 20,
+    # Built in the request without a REPORT_WORKER
+    'duc_report': 25,
+    'report_job': 10,
+    'report_job_download': 10,
+    'admin:recoup_*_changelist': 20,
+}
+
 
 # Logging settings
 LOGGING = {
@@ -101,6 +131,15 @@ LOGGING = {
             'handlers': ['console'],
 			'propagate': True,
         },
+        'recoup': {
+            'handlers': ['console'],
+            'level': 'INFO',
+        },
+        'recoup.profile': {
+            'handlers': ['console'],
+            'level': env('PROFILE_LOG_LEVEL', 'INFO'),
+            'propagate': False,
+        },
         'django.request': {
             'handlers': ['console', 'sentry'],
             'level': 'WARNING',
@@ -1,14 +1,18 @@
 from django.urls import path
 from django.contrib import admin
-from recoup.views import HomePageView, BillView, DUCReport, HealthCheckView
+from recoup.views import HomePageView, BillView, BillsZip, DUCReport, ReportJobView, ReportJobDownload, HealthCheckView, ReadinessView
 
 admin.site.site_header = HomePageView.title
 admin.site.site_name = HomePageView.title
 
 urlpatterns = [
-    path('', HomePageView.as_view()),
-    path('bill', BillView.as_view()),
-    path('reports/DUCReport.xlsx', DUCReport),
-    path('healthcheck', HealthCheckView.as_view()),
+    path('', HomePageView.as_view(), name='home'),
+    path('bill', BillView.as_view(), name='bill'),
+    path('bills.zip', BillsZip, name='bills_zip'),
+    path('reports/DUCReport.xlsx', DUCReport, name='duc_report'),
+    path('reports/jobs/<int:pk>', ReportJobView.as_view(), name='report_job'),
+    path('reports/jobs/<int:pk>/download', ReportJobDownload, name='report_job_download'),
+    path('healthcheck', HealthCheckView.as_view(), name='healthcheck'),
+    path('readiness', ReadinessView.as_view(), name='readiness'),
     path('admin/', admin.site.urls),
 ]